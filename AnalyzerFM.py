@@ -1,89 +1,363 @@
 from LastFM import LastFM
 from HighlighterFM import HighlighterFM
-from time import sleep
-from datetime import date
-from sys import exit
-import requests_cache # type: ignore
+from StoreFM import StoreFM
+from BuilderFM import BuilderFM
+from RollupFM import RollupFM
+from LRUCacheFM import LRUCacheFM
+from TrendsFM import TrendsFM
+from InstrumentFM import InstrumentFM
+from LazyLoaderFM import LazyLoaderFM
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+import sys
 import pandas as pd # type: ignore
 import numpy as np
-from IPython.core.display import clear_output # type: ignore
+
+# requests is only needed to raise the errors of failed responses, so it is imported when the first response arrives (see LastFM)... and IPython is optional
+requests = LazyLoaderFM('requests')
+ipython_display = LazyLoaderFM('IPython.display')
 
 class AnalyzerFM():
     """
     An analyzer for the user's data fetched from Last.fm.
 
     Public instance variables:
-        df: Dataframe with all scrobbles information of that user.
-        first_day: The day of the first scrobble of that user.
-        last_day: The day of the last scrobble of that user.
+        df: Dataframe with all scrobbles information of that user, sorted from the oldest to the newest scrobble. In chunked mode it is empty (it only has the categories).
+        first_day: The day of the first scrobble of that user (None while there are no scrobbles).
+        last_day: The day of the last scrobble of that user (None while there are no scrobbles).
+        cache: The LRU cache with the results of top_by() and highlights_of() (and its hits and misses).
+        instrument: The timers and counters of the fetching, parsing, building, indexing and querying stages (see InstrumentFM.stats()).
 
     Public methods:
+        refresh(): Fetches the scrobbles newer than the ones already in the dataframe.
+        sync(): Fetches the scrobbles newer than the stored ones into the user's store, without building an analyzer.
         top_by(): Finds the top Artist/Album/Track for the given period.
+        top_between(): Finds the top Artist/Album/Track between two dates (e.g. the last 30 days).
         highlights_of(): Computes the highlights of Artists, Albums, and Tracks for the given period.
+        highlights_between(): Computes the highlights of Artists, Albums, and Tracks between two dates.
+        highlights_series(): Computes the highlights of every year/month/week within a range at once.
         summary_highlights(): A comparison of the highlights of Artists, Albums, and Tracks for the given period and the previous period.
+        trends(): Returns the long-range trends of the whole history (rolling counts, streaks, discoveries, heatmaps and year-over-year deltas).
     """
-    def __init__(self, user: str) -> None:
+    def __init__(self, user: str, max_workers: int = 4, api: Optional[LastFM] = None, store_dir: str = 'scrobbles', cache_size: int = 256, offline: bool = False,
+                 start_date: Optional[str] = None, chunk_size: Optional[int] = None, instrument: Optional[InstrumentFM] = None, progress: bool = True) -> None:
         """
         Constructs the user's dataframe used for the Analyzer.
+        The scrobbles fetched by previous runs are loaded from the user's store and only the newer ones are requested to the Last.fm servers.
 
         Parameters:
             user: Last.fm username
+            max_workers: The maximum number of pages fetched concurrently. Defaults to 4. Use 1 to fetch one page at a time.
+            api: The LastFM object used to fetch the pages. Defaults to a new one (sharing it also shares its rate limit).
+            store_dir: The directory where the user's scrobbles are stored between runs. Defaults to 'scrobbles/'.
+            cache_size: How many results of top_by() and highlights_of() are kept in memory. Defaults to 256. Use 0 to disable it.
+            offline: Whether to analyze only the stored scrobbles, without requesting anything to the Last.fm servers. Defaults to False.
+            start_date: The day ('YYYY-MM-DD') from which the scrobbles are fetched. Defaults to None (the day the user registered on Last.fm).
+            chunk_size: Enables the chunked mode, for histories that do not fit comfortably in memory: the scrobbles are never loaded as a whole, only this many at a time.
+                The queries are answered from the daily rollup, which is built from partial rollups of the chunks of the store. Defaults to None (the whole dataframe is loaded).
+            instrument: Where the stages are timed and counted (e.g. InstrumentFM(sink='jsonl')). Defaults to the one of api (the requests are always timed by the one of api).
+            progress: Whether to print how many pages were fetched so far. Defaults to True. Use False for a service (e.g. ServerFM) or a batch (e.g. BatchFM).
 
         Returns:
             None.
         """
-        api = LastFM()
-        pages = []
-        current_page = 1
-
-        requests_cache.install_cache('cached_request')      # caching the get request in cached_request.sqlite for faster performance
-
-        # looping through all the response pages 
-        while True:
-            response = api.get_recent_tracks(user, '2018-01-01', date.today().strftime("%Y-%m-%d"), limit=200, page=current_page) # getting the user's recent tracks, page by page
-            
-            # verifying if the response was OK... if not print message and exit with error
-            if response.status_code != 200:
-                print(response.text)
-                exit(1)
-            
-            # verifying if the response came from the server (and not from the cache)
-            if not getattr(response, 'from_cache', False):
-                print(response.status_code, current_page, response.json()['recenttracks']['@attr']['totalPages'])
-                clear_output(wait=True)
-                sleep(0.25)
-
-            # append current response to pages
-            pages.append(response.json())
-
-            # verifying if the current page does not exceed the max page number... if it does (last one), break the loop
-            if current_page < int(response.json()['recenttracks']['@attr']['totalPages']):
-                current_page += 1
-            else:
-                print("All pages fetched!")
-                break
-        
-        # creating the dataframe to be used by the Analyzer
-        self.df = pd.DataFrame({
-            'Artist': [ scrobble['artist']['#text'] for page in pages for scrobble in page['recenttracks']['track'] ],
-            'Album': [ scrobble['album']['#text'] for page in pages for scrobble in page['recenttracks']['track'] ],
-            'Track': [ scrobble['name'] for page in pages for scrobble in page['recenttracks']['track'] ],
-            'Date': [ scrobble['date']['#text'] for page in pages for scrobble in page['recenttracks']['track'] ]
-        })
+        self.__user = user
+        self.__progress = progress
+        self.__max_workers = max(1, max_workers)
+        self.__api = api if api is not None else LastFM(instrument=instrument)
+        self.instrument = instrument if instrument is not None else self.__api.instrument
+        self.__store = StoreFM(user, store_dir)
+        self.__start_date = start_date
+        self.__chunk_size = max(1, chunk_size) if chunk_size is not None else None
+
+        # loading the scrobbles fetched by the previous runs, if there are any (just their categories, in chunked mode)
+        self.df, self.__last_uts = self.__load(self.__store, self.__api, self.instrument, chunked=self.__chunk_size is not None)
+
+        self.__sort_keys: Dict[str, np.ndarray] = {}
+        self.__rollup: Optional[RollupFM] = None
+        self.__counted_rows = 0     # how many rows were counted from the dataframe, instead of the daily rollup (see __count())
+        self.__trends: Optional[TrendsFM] = None
+        self.__epochs = np.array([], dtype=np.int64)
+        self.cache = LRUCacheFM(cache_size)
+        self.first_day: Optional[pd.Timestamp] = None
+        self.last_day: Optional[pd.Timestamp] = None
+
+        # fetching only the scrobbles newer than the stored ones (or just indexing the stored ones, if offline)
+        if offline:
+            self.__index(self.df.iloc[:0])
+        else:
+            self.refresh()
+
+
+    @staticmethod
+    def sync(user: str, api: Optional[LastFM] = None, store_dir: str = 'scrobbles', max_workers: int = 4, start_date: Optional[str] = None, chunked: bool = False,
+             progress: bool = True) -> int:
+        """
+        Fetches the scrobbles newer than the stored ones and appends them to the user's store, without building an analyzer.
+        Useful to fetch many users (network-bound) before analyzing them with AnalyzerFM(user, offline=True).
+
+        NOTE: Only the scrobbles newer than the newest stored one are kept. A scrobble submitted late (e.g. from an offline device) with a time older than that
+        is never added to the store (by this method or by refresh()), unless the store is deleted and fetched again.
+
+        Parameters:
+            user: Last.fm username
+            api: The LastFM object used to fetch the pages. Defaults to a new one.
+            store_dir: The directory where the user's scrobbles are stored. Defaults to 'scrobbles/'.
+            max_workers: The maximum number of pages fetched concurrently. Defaults to 4.
+            start_date: The day ('YYYY-MM-DD') from which the scrobbles are fetched. Defaults to None (the day the user registered on Last.fm).
+            chunked: Whether to append the new scrobbles to the store without loading the stored ones. Defaults to False.
+            progress: Whether to print how many pages were fetched so far. Defaults to True.
+
+        Returns:
+            The number of new scrobbles.
+        """
+        api = api if api is not None else LastFM()
+        store = StoreFM(user, store_dir)
+
+        df, last_uts = AnalyzerFM.__load(store, api, api.instrument, chunked)
+        return len( AnalyzerFM.__ingest(api, api.instrument, user, store, df, last_uts, max(1, max_workers), start_date, chunked, progress)[1] )
+
+
+    @staticmethod
+    def __load(store: StoreFM, api: LastFM, instrument: InstrumentFM, chunked: bool = False) -> Tuple[pd.DataFrame, Optional[int]]:
+        """Returns the stored dataframe (or, if chunked, an empty one with the stored categories) and the Unix Timestamp of its newest scrobble, or an empty dataframe and None if nothing was stored yet."""
+        with instrument.timer('load', chunked=str(chunked)) as counters:
+            stored = store.schema() if chunked else store.load()
+            counters['rows'] = len(stored[0]) if stored is not None else 0
+        if stored is not None:
+            return stored
+
+        return BuilderFM().to_df(api.timezone_offset), None
+
+
+    @staticmethod
+    def __ingest(api: LastFM, instrument: InstrumentFM, user: str, store: StoreFM, df: pd.DataFrame, last_uts: Optional[int], max_workers: int,
+                 start_date: Optional[str], chunked: bool = False, progress: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame, Optional[int]]:
+        """
+        Fetches the scrobbles newer than last_uts, appends them to df and saves it in the store. Returns the new df, the new scrobbles and the new last_uts.
+        If chunked, df is empty (it only has the stored categories): the new scrobbles are appended to the store and df just gets their categories.
+        """
+        # fetching from the start date (or the registration day, which is only requested for the first fetch) onwards, one calendar month at a time
+        start = start_date if start_date is not None or last_uts is not None else AnalyzerFM.__registration_date(api, user)
+        windows = AnalyzerFM.__windows(start, last_uts, api.timezone_offset, date.today())
+
+        # each page is consumed by the builder as soon as it arrives, so its json is not kept around... the scrobbles up to last_uts are already known
+        builder = BuilderFM(after_uts=last_uts)
+        AnalyzerFM.__fetch_pages(api, instrument, user, windows, builder.add_page, max_workers, progress)
+
+        # the new scrobbles are more recent, so they go at the bottom (the dataframe is sorted from the oldest to the newest scrobble)
+        with instrument.timer('build') as counters:
+            new_df = builder.to_df(api.timezone_offset)
+            if not new_df.empty:
+                df = AnalyzerFM.__append(df, new_df)
+            counters['rows'] = len(new_df)
+
+        # the builder has the timestamp of the newest scrobble whenever it built any
+        if not new_df.empty and builder.last_uts is not None:
+            last_uts = builder.last_uts
+            with instrument.timer('store', chunked=str(chunked)) as counters:
+                counters['rows'] = len(new_df)
+                if chunked:
+                    # df only has the new scrobbles, coded with the stored categories first... so they are appended to the store as they are
+                    store.append(df, last_uts)
+                else:
+                    store.save(df, last_uts)
+
+            if chunked:
+                df, new_df = df.iloc[:0], df
+
+        return df, new_df, last_uts
+
+
+    @staticmethod
+    def __registration_date(api: LastFM, user: str) -> str:
+        """Returns the local day ('YYYY-MM-DD') when the user registered on Last.fm."""
+        response = api.get_user_info(user)
+        if response.status_code != 200:
+            raise requests.HTTPError(f"user.getinfo failed with {response.status_code}: {response.text}", response=response)
+
+        registered = int(response.json()['user']['registered']['unixtime'])
+        return (date(1970, 1, 1) + timedelta(seconds=registered + api.timezone_offset * 3600)).strftime("%Y-%m-%d")
+
+
+    @staticmethod
+    def __windows(start: Optional[str], last_uts: Optional[int], timezone_offset: int, today: date) -> List[Tuple[Union[str, int], str]]:
+        """
+        Splits [start, today) into calendar months, the newest one first. A month that has ended always has the same bounds, so its pages never change and stay cached.
+        With last_uts, the months before the one of last_uts are skipped and that month starts right after it, so a refresh only pages through the new scrobbles.
+        """
+        last_day = date(1970, 1, 1) + timedelta(seconds=last_uts + timezone_offset * 3600) if last_uts is not None else None
+        first = max( day for day in (datetime.strptime(start, "%Y-%m-%d").date() if start is not None else None, last_day) if day is not None )
+
+        windows: List[Tuple[Union[str, int], str]] = []
+        window_start = first
+        while window_start < today:
+            next_month = (window_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+            window_end = min(next_month, today)
+
+            # the scrobbles up to last_uts are already known
+            from_date: Union[str, int] = last_uts + 1 if last_uts is not None and window_start == last_day else window_start.strftime("%Y-%m-%d")
+            windows.append( (from_date, window_end.strftime("%Y-%m-%d")) )
+            window_start = window_end
+
+        return windows[::-1]
+
+
+    def refresh(self) -> int:
+        """
+        Fetches the scrobbles newer than the newest one already in the dataframe and appends them to it (and to the user's store). The late scrobbles are lost, see sync().
+
+        Returns:
+            The number of new scrobbles.
+        """
+        self.df, new_df, self.__last_uts = self.__ingest(self.__api, self.instrument, self.__user, self.__store, self.df, self.__last_uts, self.__max_workers, self.__start_date,
+                                                        self.__chunk_size is not None, self.__progress)
+        self.__index(new_df)
+
+        return len(new_df)
 
-        # converting the Date column from string to datetime64, converting it to local timezone times and setting it as index
-        self.df['Date'] = pd.to_datetime(self.df['Date'], format='%d %b %Y, %H:%M')
 
-        self.df['Date'] = self.df['Date'] + pd.Timedelta(api.timezone_offset, 'H')
+    def __index(self, new_df: pd.DataFrame) -> None:
+        """Updates the structures used to answer the queries (epochs, sort keys, daily rollup and cache) after new_df was appended to the dataframe."""
+        with self.instrument.timer('index') as counters:
+            counters['rows'] = len(new_df)
+            self.__update_index(new_df)
 
-        self.df.set_index('Date', inplace=True)
+
+    def __update_index(self, new_df: pd.DataFrame) -> None:
+        """Updates the epochs, sort keys, daily rollup and cache (see __index())."""
+        # the local time of each scrobble in seconds (ascending), used to find the rows of any period with a binary search
+        if not new_df.empty or len(self.__epochs) != len(self.df):
+            self.__epochs = self.df.index.values.astype('datetime64[s]').astype(np.int64)
+
+        # the case-folded sort keys of the Artists, Albums and Tracks are computed again when a sort needs them (see __sort_keys_of())
+        if not new_df.empty:
+            self.__sort_keys = {}
+
+        # in chunked mode the daily rollup is built right away (there is no dataframe to count from)... otherwise when the queries need it (see __count())
+        if self.__rollup is None and self.__chunk_size is not None:
+            self.__rollup = self.__roll_up_store(self.__chunk_size)
+        elif not new_df.empty:
+            # in a rollup already built, only the days of the new scrobbles are recomputed (or, in chunked mode, merged)
+            if self.__rollup is not None and self.__chunk_size is None:
+                self.__rollup.update(self.df, since=new_df.index.min())
+            elif self.__rollup is not None:
+                self.__rollup.merge(RollupFM(new_df))
+                self.first_day = self.first_day if self.first_day is not None else new_df.index[0]
+                self.last_day = new_df.index[-1]
+
+            # the trends are rebuilt from the updated rollup when they are needed again
+            self.__trends = None
+
+            # the cached periods that end after the first new scrobble have changed... the finished ones are kept
+            since = int(new_df.index[:1].values.astype('datetime64[s]').astype(np.int64)[0])
+            self.cache.invalidate(lambda key: key[2] > since)
 
         # saving the date of the first and last scrobble
-        self.first_day = self.df.index[-1]
-        self.last_day = self.df.index[0]
+        if not self.df.empty:
+            self.first_day = self.df.index[0]
+            self.last_day = self.df.index[-1]
+
+
+    def __roll_up_store(self, chunk_size: int) -> RollupFM:
+        """Builds the daily rollup of the whole store (chunked mode) by merging the partial rollups of its chunks of chunk_size scrobbles, so only one chunk is in memory at a time."""
+        rollup = RollupFM(self.df)
+        partials = []
+
+        for chunk in self.__store.scan(chunk_size):
+            partials.append(RollupFM(chunk))
+
+            # saving the date of the first and last scrobble
+            self.first_day = self.first_day if self.first_day is not None else chunk.index[0]
+            self.last_day = chunk.index[-1]
+
+        rollup.merge(*partials)
+        return rollup
+
 
-        # empty albums cells means that the song was listened in the Last.fm Web Player
-        self.df['Album'] = self.df['Album'].replace('', 'Last.fm Web Player')
+    @staticmethod
+    def __append(df: pd.DataFrame, new_df: pd.DataFrame) -> pd.DataFrame:
+        """Puts new_df at the bottom of df. The categories of df keep their codes and the unseen values of new_df are added after them."""
+        df, new_df = df.copy(), new_df.copy()
+
+        for column in ('Artist', 'Album', 'Track'):
+            categories = df[column].cat.categories
+            categories = categories.append( new_df[column].cat.categories.difference(categories, sort=False) )
+
+            # with the same categories on both sides, the concatenation stays categorical
+            df[column] = df[column].cat.set_categories(categories)
+            new_df[column] = new_df[column].cat.set_categories(categories)
+
+        df = pd.concat([df, new_df])
+
+        # keeping the dataframe sorted even if the new scrobbles overlap the old ones (the ties keep their order)
+        return df if df.index.is_monotonic_increasing else df.sort_index(kind='stable')
+
+
+    @staticmethod
+    def __case_folded_ranks(categories: pd.Index) -> np.ndarray:
+        """Returns, for each category code, the rank of its upper-cased value. Values that only differ in case share the same rank."""
+        return np.unique(categories.str.upper().to_numpy(dtype=object), return_inverse=True)[1].reshape(-1)
+
+
+    def __sort_keys_of(self, column: str, codes: np.ndarray) -> np.ndarray:
+        """
+        Returns the case-folded sort keys of the codes of the column (Artist, Album or Track).
+        A few codes (e.g. the ties of a top 1) are ranked among themselves, which keeps their order... the keys of all the categories are only computed (once) for bigger sorts.
+        """
+        if column not in self.__sort_keys and len(codes) <= 1024:
+            return self.__case_folded_ranks(self.df[column].cat.categories.take(codes))
+
+        if column not in self.__sort_keys:
+            self.__sort_keys[column] = self.__case_folded_ranks(self.df[column].cat.categories)
+        return self.__sort_keys[column][codes]
+
+
+    @staticmethod
+    def __fetch_pages(api: LastFM, instrument: InstrumentFM, user: str, windows: List[Tuple[Union[str, int], str]], consume: Callable[[Dict[str, Any]], None], max_workers: int,
+                      progress: bool = True) -> None:
+        """Fetches all the pages of the user's recent tracks within each [from_date, to_date) window and hands their json to consume() in window and page order (printing the progress, if asked)."""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # fetching the first page of every window to know how many pages each one has
+            first_pages = list(executor.map(lambda window: AnalyzerFM.__fetch_page(api, instrument, user, window[0], window[1], 1), windows))
+
+            # fetching the remaining pages of all the windows concurrently... map() hands them back in window and page order
+            tasks = [ (index, page) for index, first_page in enumerate(first_pages) for page in range(1, max(1, int(first_page['recenttracks']['@attr']['totalPages'])) + 1) ]
+            pages = executor.map(lambda task: first_pages[task[0]] if task[1] == 1 else AnalyzerFM.__fetch_page(api, instrument, user, windows[task[0]][0], windows[task[0]][1], task[1]), tasks)
+            for fetched, page_json in enumerate(pages, start=1):
+                with instrument.timer('add_page') as counters:
+                    consume(page_json)
+                    counters['rows'] = len(page_json['recenttracks']['track'])
+
+                # the progress is printed by this thread only, so the lines of the pages fetched concurrently are never interleaved
+                if progress:
+                    print(f"{fetched} of {len(tasks)} pages fetched")
+
+                    # the progress is only cleared when running within IPython (e.g. a notebook), which the analyzer never imports by itself
+                    if 'IPython' in sys.modules:
+                        ipython_display.clear_output(wait=True)
+
+        if progress:
+            print("All pages fetched!")
+
+
+    @staticmethod
+    def __fetch_page(api: LastFM, instrument: InstrumentFM, user: str, from_date: Union[str, int], to_date: str, page: int) -> Dict[str, Any]:
+        """Fetches a single page of the user's recent tracks and returns its json. If the response was still not OK after the client's retries, an HTTPError is raised."""
+        response = api.get_recent_tracks(user, from_date, to_date, limit=200, page=page)
+
+        # verifying if the response was OK... if not raise an error with the server's message
+        if response.status_code != 200:
+            raise requests.HTTPError(f"page {page} failed with {response.status_code}: {response.text}", response=response)
+
+        # parsing the json only once
+        with instrument.timer('parse') as counters:
+            page_json = response.json()
+            counters.update(rows=len(page_json['recenttracks']['track']), bytes=len(response.content))
+
+        return page_json
 
 
     @staticmethod
@@ -104,39 +378,184 @@ class AnalyzerFM():
             return 0    # no scrobbles during the current and last period: 0%
 
 
+    def __rank(self, codes: Dict[str, np.ndarray], counts: np.ndarray, category: str, n: Optional[int] = None) -> pd.DataFrame:
+        """Sorts the counted keys by count, then artist and then by album/track (case-insensitively) and returns the top n of them (all if n is None) as a dataframe."""
+        keys = {'Artist': ['Artist'], 'Album': ['Album', 'Artist'], 'Track': ['Track', 'Artist']}[category]
+        columns = {'Artist': ['Artist'], 'Album': ['Artist', 'Album'], 'Track': ['Artist', 'Album', 'Track']}[category]
+
+        # when only the top n are needed, only the keys counted at least as much as the n-th one are sorted (the ties are kept for the tie-breaks)
+        candidates = np.arange(len(counts))
+        if n is not None and 0 < n < len(counts):
+            threshold = np.partition(counts, len(counts) - n)[len(counts) - n]
+            candidates = np.flatnonzero(counts >= threshold)
+
+        order = candidates[ np.lexsort([ self.__sort_keys_of(key, codes[key][candidates]) for key in keys ] + [-counts[candidates]]) ]
+        if n is not None:
+            order = order[:max(0, n)]
+
+        # decoding the sorted codes back to their names
+        top = pd.DataFrame({ column: self.df[column].cat.categories.take(codes[column][order]) for column in columns })
+        top['Count'] = counts[order]
+        return top
+
+
     @staticmethod
-    def __top(df: pd.DataFrame, category: str) -> pd.DataFrame:
-        """Finds the top category (how many times an Artist, Track or Album was scrobbled) in the given dataframe and returns a new dataframe with them."""
-        new_df = df.copy()
+    def __seconds(*dates: Union[str, pd.Timestamp]) -> List[int]:
+        """Converts the dates to seconds since 1970-01-01 (local time, just like the dataframe index)."""
+        return [ int(seconds) for seconds in pd.DatetimeIndex([ pd.Timestamp(date) for date in dates ]).values.astype('datetime64[s]').astype(np.int64) ]
 
-        if category == 'Track':
-            new_df['Count'] = new_df.groupby(['Track', 'Artist']).transform('count')
-            new_df.drop_duplicates(['Track', 'Artist'], inplace=True)
 
-            # sorting by count, then artist and then by track
-            return new_df.iloc[ np.lexsort([new_df['Track'].str.upper(), new_df['Artist'].str.upper(), -new_df['Count']]) ].reset_index(drop=True)
-        
-        elif category == 'Album':
-            new_df = new_df[ ~(new_df['Album'] == 'Last.fm Web Player') ]     # dropping the songs that were listened in Last.fm Web Player
-            
-            new_df['Count'] = new_df.groupby(['Album', 'Artist']).transform('count')
-            new_df = new_df.drop_duplicates(['Album', 'Artist']).drop('Track', axis='columns')
+    def __bounds(self, period: str, date: str) -> Tuple[int, int]:
+        """Returns the seconds [start, end) of the given period."""
+        if period == 'year' or period == 'month':
+            # just like slicing the dataframe with the date string, the resolution comes from the string itself (e.g. '2021-8' is a month)
+            start, end = pd.Period(date).start_time, (pd.Period(date) + 1).start_time
+
+        else: # period == 'week':
+            # the day passed is open-ended, so the week goes from 7 days before it until the end of the day before it
+            end = pd.Timestamp(date)
+            start = end - pd.Timedelta(7, 'D')
+
+        start_seconds, end_seconds = self.__seconds(start, end)
+        return start_seconds, end_seconds
+
+
+    def __rows(self, start: int, end: int) -> slice:
+        """Finds, with a binary search, the rows of the dataframe scrobbled within the seconds [start, end)."""
+        first, last = np.searchsorted(self.__epochs, [start, end], side='left')
+        return slice(int(first), int(last))
+
+
+    def __daily(self) -> RollupFM:
+        """Returns the daily rollup of the dataframe, building it on the first call (in chunked mode it is built with the index)."""
+        if self.__rollup is None:
+            with self.instrument.timer('rollup') as counters:
+                self.__rollup = RollupFM(self.df)
+                counters['rows'] = len(self.df)
+
+        return self.__rollup
+
+
+    def __count(self, start: int, end: int, category: str) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        Counts each key of the category scrobbled within the seconds [start, end), from the daily rollup when the range has whole days or from a view of the dataframe otherwise.
+        Until the rollup is built, the whole days are counted from the dataframe too... it is only built once the rows counted so far add up to the whole dataframe
+        (about what building it costs), so a short run with a few queries never pays for it.
+        """
+        if start % 86400 == 0 and end % 86400 == 0:
+            if self.__rollup is None:
+                rows = self.__rows(start, end)
+                self.__counted_rows += rows.stop - rows.start
+            if self.__rollup is not None or self.__counted_rows > len(self.df):
+                return self.__daily().count(start // 86400, end // 86400, category)
+
+        # the rows are a contiguous view of the codes... walked from the newest to the oldest scrobble
+        if self.__chunk_size is None:
+            rows = self.__rows(start, end)
+            return self.__count_codes({ column: self.df[column].cat.codes.to_numpy()[rows][::-1] for column in ('Artist', 'Album', 'Track') }, category)
+
+        # in chunked mode each chunk of the store is counted on its own and the partial counts are merged (just like the daily rollup is built), so only one chunk is in memory...
+        # the newest chunk goes first, so each key keeps the codes of its most recent scrobble and the keys stay the most recently scrobbled first
+        partials = [ self.__count_codes({ column: chunk[column].cat.codes.to_numpy()[::-1] for column in ('Artist', 'Album', 'Track') }, category)
+                     for chunk in self.__store.scan(self.__chunk_size, start, end) ][::-1]
+        chunk_rows = { column: np.concatenate([np.array([], dtype=np.int64)] + [ codes[column] for codes, _ in partials ]) for column in ('Artist', 'Album', 'Track') }
+        return RollupFM.count_rows(chunk_rows, category, weights=np.concatenate([np.array([], dtype=np.int64)] + [ counts for _, counts in partials ]))
+
+
+    def __count_codes(self, codes: Dict[str, np.ndarray], category: str) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """Counts each key of the category within the given codes of the Artists, Albums and Tracks (the newest scrobble first), see __count()."""
+        # dropping the songs that were listened in Last.fm Web Player
+        if category == 'Album':
+            listened = codes['Album'] != self.df['Album'].cat.categories.get_indexer(['Last.fm Web Player'])[0]
+            codes = { column: column_codes[listened] for column, column_codes in codes.items() }
 
-            # sorting by count, then artist and then by album
-            return new_df.iloc[ np.lexsort([new_df['Album'].str.upper(), new_df['Artist'].str.upper(), -new_df['Count']]) ].reset_index(drop=True)
+        return RollupFM.count_rows(codes, category)
 
-        elif category == 'Artist':
-            new_df['Count'] = new_df.groupby('Artist').transform('count')['Album']
-            new_df = new_df.drop_duplicates('Artist').drop(['Track', 'Album'], axis='columns')
 
-            # sorting by count and then by artist
-            return new_df.iloc[ np.lexsort([new_df['Artist'].str.upper(), -new_df['Count']]) ].reset_index(drop=True)
+    def trends(self) -> TrendsFM:
+        """
+        Returns the long-range trends of the whole history (see TrendsFM), built on the first call after new scrobbles arrived.
+
+        Returns:
+            The TrendsFM with the rolling counts, streaks, discoveries, heatmaps and year-over-year deltas of the history.
+        """
+        if self.__trends is None:
+            with self.instrument.timer('trends') as counters:
+                # the hours of the scrobbles come from the dataframe (or, in chunked mode, from each chunk of the store)
+                epochs = [self.__epochs] if self.__chunk_size is None else ( chunk.index.values.astype('datetime64[s]').astype(np.int64) for chunk in self.__store.scan(self.__chunk_size) )
+                self.__trends = TrendsFM(self.__daily(), { column: self.df[column].cat.categories for column in ('Artist', 'Album', 'Track') }, epochs)
+                counters['rows'] = len(self.__epochs) if self.__chunk_size is None else 0
+
+        return self.__trends
+
+
+    def __top(self, start: int, end: int, category: str, n: Optional[int]) -> pd.DataFrame:
+        """Finds the top category within the seconds [start, end), using the cache if that range was already computed."""
+        # the cache is keyed by the seconds of the range, so equivalent dates (e.g. '2021-8' and '2021-08') share the same entry
+        key = ('top', start, end, category, n)
+
+        # computing the dataframe with the top values of the chosen category, if it was not cached yet
+        with self.instrument.timer('top', category=category) as counters:
+            top = self.cache.get(key)
+            counters['cached'] = int(top is not None)
+            if top is None:
+                top = self.__rank(*self.__count(start, end, category), category, n)
+                self.cache.put(key, top)
+            counters['rows'] = len(top)
+
+        # returning a copy so the cached dataframe cannot be changed by the caller
+        return top.copy()
+
+
+    def __highlights(self, period: str, start: int, end: int, days: int) -> HighlighterFM:
+        """Computes the highlights within the seconds [start, end), using the cache if that range was already computed. The average daily is computed over the given number of days."""
+        with self.instrument.timer('highlights', period=period) as counters:
+            # returning the cached highlights, if this range was already computed
+            key = ('highlights', start, end, period, days)
+            highlights = self.cache.get(key)
+            counters['cached'] = int(highlights is not None)
+            if highlights is None:
+                highlights = self.__compute_highlights(period, start, end, days)
+                self.cache.put(key, highlights)
+
+        # returning a copy of its series (the dataclass is frozen, but they are not) so the cached highlights cannot be changed by the caller
+        return dataclasses.replace(highlights, df_top_artist=highlights.df_top_artist.copy(), df_top_album=highlights.df_top_album.copy(), df_top_track=highlights.df_top_track.copy())
+
+
+    def __compute_highlights(self, period: str, start: int, end: int, days: int) -> HighlighterFM:
+        """Computes the highlights within the seconds [start, end) (see __highlights()), without the cache."""
+        # counting the artists, albums, and tracks of the given range
+        artists = self.__count(start, end, 'Artist')
+        albums = self.__count(start, end, 'Album')
+        tracks = self.__count(start, end, 'Track')
+
+        # computing the fields of the given range
+        total_artists = len(artists[1])
+        total_albums = len(albums[1])
+        total_tracks = len(tracks[1])
+        total_scrobbles = int(tracks[1].sum())
+        average_daily = round(total_scrobbles / days)
+
+        # finding the most listened artist, album, and track name (only the first of each is sorted)
+        df_top_artist = self.__rank(*artists, 'Artist', n=1).iloc[0] if total_artists > 0 else pd.Series(data={'Artist': '-', 'Count': 0})
+        df_top_album = self.__rank(*albums, 'Album', n=1).iloc[0] if total_albums > 0 else pd.Series(data={'Artist': '-', 'Album': '-', 'Count': 0})
+        df_top_track = self.__rank(*tracks, 'Track', n=1).iloc[0] if total_tracks > 0 else pd.Series(data={'Artist': '-', 'Album': '-', 'Track': '-', 'Count': 0})
         
-        else:
-            raise ValueError(f"category should be: 'Artist', 'Album' or 'Track', but '{category}' was passed.")
+        # setting the HighlighterFM fields and returning it
+        return HighlighterFM(
+            period,
+            total_artists,
+            total_albums,
+            total_tracks,
+            total_scrobbles,
+            average_daily,
+            df_top_artist,
+            df_top_album,
+            df_top_track
+        )
 
 
-    def top_by(self, period: str, date: str, category: str) -> pd.DataFrame:
+    def top_by(self, period: str, date: str, category: str, n: Optional[int] = None) -> pd.DataFrame:
         """
         Finds the top Artist/Album/Track for the given period.
 
@@ -144,6 +563,7 @@ class AnalyzerFM():
             period: Can either be 'year', 'month', or 'week'.
             date: If period is 'year' then date is 'YYYY'. For 'month', date is 'YYYY-MM'. And, for 'week', data is 'YYYY-MM-DD'.
             category: Can either be 'Artist', 'Album', or 'Track'.
+            n: How many of the top values to return. Defaults to None (all of them), which is slower than asking only for the few needed.
 
             NOTE: If date='week', then the day passed as parameter is open-ended, meaning that the day in 'date' is not taken into account (only the day before).
 
@@ -154,16 +574,27 @@ class AnalyzerFM():
         self.__validate_period(period)
 
         # returns a dataframe with the top values of the chosen category
-        if period == 'year' or period == 'month':
-            return self.__top(self.df.loc[date], category)
+        return self.__top(*self.__bounds(period, date), category, n)
 
-        else: # period == 'week':
-            current_week = pd.Timestamp(date)
-            last_week = current_week - pd.Timedelta(7, 'D')
-            current_week -= pd.Timedelta(1, 'S')    # current_week looks like Timestamp('YYYY-MM-DD 23:59:59')
 
-            # OBS: the dataframe slice below is made using Timestamps ('YYYY-MM-DD hh:mm:ss') and not strings
-            return self.__top(self.df.loc[current_week:last_week], category)
+    def top_between(self, start: str, end: str, category: str, n: Optional[int] = None) -> pd.DataFrame:
+        """
+        Finds the top Artist/Album/Track scrobbled within [start, end), e.g. a rolling window such as the last 30 days.
+
+        Parameters:
+            start: String ('YYYY-MM-DD' or 'YYYY-MM-DD hh:mm:ss') of the beginning of the range (closed interval).
+            end: String ('YYYY-MM-DD' or 'YYYY-MM-DD hh:mm:ss') of the end of the range (opened interval).
+            category: Can either be 'Artist', 'Album', or 'Track'.
+            n: How many of the top values to return. Defaults to None (all of them).
+
+        Returns:
+            A dataframe with the top values of the chosen category.
+        """
+        start_seconds, end_seconds = self.__seconds(start, end)
+        if end_seconds <= start_seconds:
+            raise ValueError(f"end should be after start, but '{start}' and '{end}' were passed.")
+
+        return self.__top(start_seconds, end_seconds, category, n)
 
 
     def highlights_of(self, period: str, date: str) -> HighlighterFM:
@@ -182,40 +613,86 @@ class AnalyzerFM():
         # verifying if the period passed is valid
         self.__validate_period(period)
 
-        # creating the dataframes with artists, albums, and tracks of the given period
-        df_artists = self.top_by(period, date, 'Artist')
-        df_albums = self.top_by(period, date, 'Album')
-        df_tracks = self.top_by(period, date, 'Track')
-
-        # computing the fields of the given period
-        total_artists = df_artists.value_counts('Artist').sum()
-        total_albums = df_albums.value_counts('Album').sum()
-        total_tracks = df_tracks.value_counts('Track').sum()
-        total_scrobbles = df_tracks['Count'].sum()
-        average_daily = round(total_scrobbles / {'year': 365, 'month': 30, 'week': 7}[period])
-
-        # finding the most listened artist, album, and track name
-        if not df_tracks.empty:
-            df_top_artist = df_artists.iloc[0]
-            df_top_album = df_albums.iloc[0]
-            df_top_track = df_tracks.iloc[0]
-        else:
-            df_top_artist = pd.Series(data={'Artist': '-', 'Count': 0})
-            df_top_album = pd.Series(data={'Artist': '-', 'Album': '-', 'Count': 0})
-            df_top_track = pd.Series(data={'Artist': '-', 'Album': '-', 'Track': '-', 'Count': 0})
-        
-        # setting the HighlighterFM fields and returning it
-        return HighlighterFM(
-            period,
-            total_artists,
-            total_albums,
-            total_tracks,
-            total_scrobbles,
-            average_daily,
-            df_top_artist,
-            df_top_album,
-            df_top_track
-        )
+        return self.__highlights(period, *self.__bounds(period, date), {'year': 365, 'month': 30, 'week': 7}[period])
+
+
+    def highlights_between(self, start: str, end: str) -> HighlighterFM:
+        """
+        Creates and returns a HighlighterFM dataclass that contains the highlights of Artists, Albums, and Tracks scrobbled within [start, end).
+
+        Parameters:
+            start: String ('YYYY-MM-DD' or 'YYYY-MM-DD hh:mm:ss') of the beginning of the range (closed interval).
+            end: String ('YYYY-MM-DD' or 'YYYY-MM-DD hh:mm:ss') of the end of the range (opened interval).
+
+        Returns:
+            A HighlighterFM dataclass with the highlights of the range. Its period is 'start/end' and its average daily is computed over the days of the range.
+        """
+        start_seconds, end_seconds = self.__seconds(start, end)
+        if end_seconds <= start_seconds:
+            raise ValueError(f"end should be after start, but '{start}' and '{end}' were passed.")
+
+        return self.__highlights(f'{start}/{end}', start_seconds, end_seconds, -(-(end_seconds - start_seconds) // 86400))
+
+
+    def highlights_series(self, freq: str, start: str, end: str) -> pd.DataFrame:
+        """
+        Computes the highlights of every year/month/week within [start, end) at once, with a single grouped pass over the daily rollup of each category.
+
+        Parameters:
+            freq: Can either be 'Y' (years), 'M' (months), or 'W' (weeks, from Monday to Sunday).
+            start: String ('YYYY-MM-DD') of the first day (closed interval).
+            end: String ('YYYY-MM-DD') of the day after the last one (opened interval).
+
+            NOTE: A period that is only partially within [start, end) only has the scrobbles of the days within it.
+
+        Returns:
+            A dataframe with one row per period (even the ones without scrobbles) and the columns:
+                period, total_artists, total_albums, total_tracks, total_scrobbles, average_daily,
+                top_artist, top_artist_count, top_album, top_album_artist, top_album_count, top_track, top_track_album, top_track_artist, top_track_count.
+        """
+        if freq not in ('Y', 'M', 'W'):
+            raise ValueError(f"freq should be: 'Y', 'M' or 'W', but '{freq}' was passed.")
+        if pd.Timestamp(end) <= pd.Timestamp(start):
+            raise ValueError(f"end should be after start, but '{start}' and '{end}' were passed.")
+
+        # the ordinals of the periods are offset by the first one so they can be used as group ids
+        pandas_freq = {'Y': 'Y', 'M': 'M', 'W': 'W-SUN'}[freq]
+        periods = pd.period_range(pd.Timestamp(start), pd.Timestamp(end) - pd.Timedelta(1, 'D'), freq=pandas_freq)
+        start_day, end_day = RollupFM.days_of(pd.DatetimeIndex([start, end]))
+
+        def groups(days: np.ndarray) -> np.ndarray:
+            return pd.DatetimeIndex(days.astype('datetime64[D]')).to_period(pandas_freq).asi8 - periods[0].ordinal
+
+        series = pd.DataFrame({'period': periods.astype(str)})
+
+        for category, columns in (('Artist', ['Artist']), ('Album', ['Album', 'Artist']), ('Track', ['Track', 'Album', 'Artist'])):
+            codes, counts = self.__daily().count(int(start_day), int(end_day), category, groups=groups)
+            keys = ['Track', 'Artist'] if category == 'Track' else columns
+
+            # the totals are how many distinct keys each period has
+            series[f'total_{category.lower()}s'] = np.bincount(codes['Group'], minlength=len(periods))
+            if category == 'Track':
+                series['total_scrobbles'] = np.bincount(codes['Group'], weights=counts, minlength=len(periods)).astype(np.int64)
+
+            # sorting by period, then by count, artist and album/track... the first key of each period is its top one
+            order = np.lexsort([ self.__sort_keys_of(key, codes[key]) for key in keys ] + [-counts, codes['Group']])
+            order = order[ np.concatenate([[True], np.diff(codes['Group'][order]) != 0]) ] if len(order) > 0 else order
+            top_periods = codes['Group'][order]
+
+            # the periods without scrobbles get the same placeholders as highlights_of()
+            prefix = f'top_{category.lower()}'
+            for column in columns:
+                name = prefix if column == category else f'{prefix}_{column.lower()}'
+                series[name] = '-'
+                series.loc[top_periods, name] = self.df[column].cat.categories.take(codes[column][order])
+            series[f'{prefix}_count'] = 0
+            series.loc[top_periods, f'{prefix}_count'] = counts[order]
+
+        series['average_daily'] = (series['total_scrobbles'] / {'Y': 365, 'M': 30, 'W': 7}[freq]).round().astype(np.int64)
+
+        return series[['period', 'total_artists', 'total_albums', 'total_tracks', 'total_scrobbles', 'average_daily',
+                       'top_artist', 'top_artist_count', 'top_album', 'top_album_artist', 'top_album_count',
+                       'top_track', 'top_track_album', 'top_track_artist', 'top_track_count']]
 
 
     def summary_highlights(self, period: str, date: str) -> str:
@@ -242,12 +719,12 @@ class AnalyzerFM():
         # computing the highlights of the current date
         current_highlights = self.highlights_of(period, date)
 
-        # computing the highlights of the previous date
+        # computing the highlights of the previous date (the previous calendar year or month, not 52 or 4 weeks before)
         if period == 'year':
-            previous_date = pd.Timestamp.strftime(pd.Timestamp(date) - pd.Timedelta(52, 'W'), format='%Y')
+            previous_date = pd.Timestamp.strftime(pd.Timestamp(date) - pd.DateOffset(years=1), format='%Y')
 
         elif period == 'month':
-            previous_date = pd.Timestamp.strftime(pd.Timestamp(date) - pd.Timedelta(4, 'W'), format='%Y-%m')
+            previous_date = pd.Timestamp.strftime(pd.Timestamp(date) - pd.DateOffset(months=1), format='%Y-%m')
 
         else: # period == 'week':
             previous_date = pd.Timestamp.strftime(pd.Timestamp(date) - pd.Timedelta(1, 'W'), format='%Y-%m-%d')
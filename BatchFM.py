@@ -0,0 +1,188 @@
+from AnalyzerFM import AnalyzerFM
+from LastFM import LastFM
+from StoreFM import StoreFM
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+import json
+import multiprocessing
+import os
+import sys
+
+def analyze_user(user: str, period: str, date: str, n: int, store_dir: str) -> Dict[str, Any]:
+    """
+    Builds the analyzer of an already synced user (without any request) and computes its reports. Runs in the worker processes of BatchFM.
+
+    Parameters:
+        user: Last.fm username
+        period: Can either be 'year', 'month', or 'week'.
+        date: The date of the period, in the format expected by AnalyzerFM.summary_highlights().
+        n: How many Artists, Albums and Tracks the top reports have.
+        store_dir: The directory where the users' scrobbles are stored.
+
+    Returns:
+        A dict with the summary, the top n Artists/Albums/Tracks of the period and how long each step took.
+        A user whose scrobbles were not stored yet raises a LookupError (instead of an empty report), so that user is not checkpointed and is tried again by the next run.
+    """
+    if StoreFM(user, store_dir).schema() is None:
+        raise LookupError(f"the scrobbles of '{user}' were not stored yet.")
+
+    start = perf_counter()
+    analyzer = AnalyzerFM(user, store_dir=store_dir, offline=True)
+    loaded = perf_counter()
+
+    summary = analyzer.summary_highlights(period, date)
+    tops = { category: analyzer.top_by(period, date, category, n=n).to_dict('records') for category in ('Artist', 'Album', 'Track') }
+
+    return {
+        'summary': summary,
+        'top': tops,
+        'scrobbles': len(analyzer.df),
+        'timings': {'load': loaded - start, 'analyze': perf_counter() - loaded}
+    }
+
+
+class BatchFM:
+    """
+    A batch runner producing the reports (summary highlights and top Artists/Albums/Tracks) of many users in parallel.
+    The fetching is network-bound, so it runs in threads sharing one rate-limited LastFM object. The analysis runs in worker processes.
+    Each finished user is checkpointed, so a crashed run resumes from where it stopped.
+
+    Public instance variables:
+        timings: How long (in seconds) each step took for each user of the last run.
+
+    Public methods:
+        run(): Produces the reports of the given users.
+    """
+    def __init__(self, period: str, date: str, n: int = 5, processes: Optional[int] = None, fetch_threads: int = 8, max_workers: int = 2,
+                 api: Optional[LastFM] = None, store_dir: str = 'scrobbles', checkpoint_dir: str = 'batch') -> None:
+        """
+        Constructs the batch runner.
+
+        Parameters:
+            period: Can either be 'year', 'month', or 'week'.
+            date: The date of the period, in the format expected by AnalyzerFM.summary_highlights().
+            n: How many Artists, Albums and Tracks the top reports have. Defaults to 5.
+            processes: How many worker processes analyze the users. Defaults to the number of CPUs.
+            fetch_threads: How many users are fetched at the same time. Defaults to 8.
+            max_workers: How many pages of each user are fetched at the same time. Defaults to 2.
+            api: The LastFM object shared by all the fetches (and so its rate limit). Defaults to a new one.
+            store_dir: The directory where the users' scrobbles are stored. Defaults to 'scrobbles/'.
+            checkpoint_dir: The directory where the report of each finished user is saved. Defaults to 'batch/'.
+
+        Returns:
+            None.
+        """
+        self.__period = period
+        self.__date = date
+        self.__n = n
+        self.__processes = processes
+        self.__fetch_threads = max(1, fetch_threads)
+        self.__max_workers = max(1, max_workers)
+        self.__api = api if api is not None else LastFM()
+        self.__store_dir = store_dir
+        self.__checkpoint_dir = checkpoint_dir
+        self.__lock = Lock()
+        self.timings: Dict[str, Dict[str, float]] = {}
+
+
+    def __checkpoint_path(self, user: str) -> str:
+        """Returns the path of the user's checkpoint."""
+        return os.path.join(self.__checkpoint_dir, f'{user}.json')
+
+
+    def __load_checkpoint(self, user: str) -> Optional[Dict[str, Any]]:
+        """Returns the report of the user saved by a previous run with the same period, date and n, or None if there is none."""
+        try:
+            with open(self.__checkpoint_path(user)) as checkpoint:
+                report = json.load(checkpoint)
+        except (OSError, ValueError):
+            return None
+
+        return report if report.get('query') == [self.__period, self.__date, self.__n] else None
+
+
+    def __save_checkpoint(self, user: str, report: Dict[str, Any]) -> None:
+        """Saves the user's report, writing to a temporary file first so a crash never leaves a half-written checkpoint behind."""
+        os.makedirs(self.__checkpoint_dir, exist_ok=True)
+
+        with open(self.__checkpoint_path(user) + '.tmp', 'w') as checkpoint:
+            json.dump(report, checkpoint, default=str)
+        os.replace(self.__checkpoint_path(user) + '.tmp', self.__checkpoint_path(user))
+
+
+    def __finish(self, user: str, fetch_seconds: float, future: 'Future[Dict[str, Any]]', reports: Dict[str, Dict[str, Any]]) -> None:
+        """Checkpoints the report of a user whose analysis finished (or records its error) and prints its timings."""
+        try:
+            report = future.result()
+        except Exception as error:
+            report = {'error': repr(error), 'timings': {}}
+
+        report['query'] = [self.__period, self.__date, self.__n]
+        report['timings']['fetch'] = fetch_seconds
+
+        # only the successful reports are checkpointed, so the failed users are tried again by the next run
+        if 'error' not in report:
+            self.__save_checkpoint(user, report)
+
+        with self.__lock:
+            reports[user] = report
+            self.timings[user] = report['timings']
+            print(f"{user}: " + ', '.join( f'{step} {seconds:.2f}s' for step, seconds in report['timings'].items() ) + (f" ({report['error']})" if 'error' in report else ''))
+
+
+    def run(self, users: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Produces the reports of the given users. The users already checkpointed (for the same period, date and n) are not processed again.
+
+        Parameters:
+            users: The Last.fm usernames.
+
+        Returns:
+            A dict with the report of each user: its summary, its top Artists/Albums/Tracks and its timings (or the error that stopped it).
+        """
+        reports: Dict[str, Dict[str, Any]] = {}
+
+        # resuming a previous run: the checkpointed users are just loaded
+        pending = []
+        for user in dict.fromkeys(users):
+            report = self.__load_checkpoint(user)
+            if report is not None:
+                reports[user] = report
+            else:
+                pending.append(user)
+
+        print(f"{len(reports)} users already checkpointed, {len(pending)} to go")
+
+        # the workers are spawned (and not forked) because the fetching threads may be holding locks when they start
+        with ProcessPoolExecutor(max_workers=self.__processes, mp_context=multiprocessing.get_context('spawn')) as processes:
+
+            def fetch(user: str) -> None:
+                """Syncs the user's store and hands the analysis to the worker processes."""
+                start = perf_counter()
+                try:
+                    AnalyzerFM.sync(user, api=self.__api, store_dir=self.__store_dir, max_workers=self.__max_workers, progress=False)
+                except Exception as error:
+                    # a failed fetch is reported like a failed analysis
+                    failed: 'Future[Dict[str, Any]]' = Future()
+                    failed.set_exception(RuntimeError(f'fetch failed: {error!r}'))
+                    self.__finish(user, perf_counter() - start, failed, reports)
+                    return
+
+                fetch_seconds = perf_counter() - start
+                future = processes.submit(analyze_user, user, self.__period, self.__date, self.__n, self.__store_dir)
+                future.add_done_callback(lambda done: self.__finish(user, fetch_seconds, done, reports))
+
+            with ThreadPoolExecutor(max_workers=self.__fetch_threads) as threads:
+                list(threads.map(fetch, pending))
+
+        return reports
+
+
+if __name__ == '__main__':
+    # usage: python BatchFM.py <file with one username per line> <period> <date>
+    with open(sys.argv[1]) as users_file:
+        usernames = [ line.strip() for line in users_file if line.strip() ]
+
+    BatchFM(sys.argv[2], sys.argv[3]).run(usernames)
@@ -0,0 +1,98 @@
+from array import array
+from typing import Any, Dict, List, Optional
+import numpy as np
+import pandas as pd # type: ignore
+
+class BuilderFM:
+    """
+    A streaming builder of the scrobbles dataframe. Each page is consumed in a single pass as soon as it arrives and its json can be thrown away right after.
+
+    Public instance variables:
+        last_uts: The Unix Timestamp of the newest scrobble added so far (None if no scrobble was added).
+
+    Public methods:
+        add_page(): Appends the scrobbles of a user.getrecenttracks page to the column buffers.
+        to_df(): Creates the dataframe with all the scrobbles added so far.
+    """
+    def __init__(self, after_uts: Optional[int] = None) -> None:
+        """
+        Constructs the empty column buffers.
+
+        Parameters:
+            after_uts: The Unix Timestamp of the newest scrobble already known. The scrobbles up to it are skipped. Defaults to None (none is skipped).
+
+        Returns:
+            None.
+        """
+        self.last_uts: Optional[int] = None
+        self.__after_uts = after_uts
+
+        # each string column is kept as int codes plus the dictionary of its distinct values, so repeated names are stored once
+        self.__codes = { column: array('i') for column in ('Artist', 'Album', 'Track') }
+        self.__values: Dict[str, Dict[str, int]] = { column: {} for column in ('Artist', 'Album', 'Track') }
+        self.__uts = array('q')
+
+
+    def __len__(self) -> int:
+        """Returns how many scrobbles were added so far."""
+        return len(self.__uts)
+
+
+    def __append(self, column: str, value: str) -> None:
+        """Appends the code of value to the column buffer, adding value to the column's dictionary if it is new."""
+        values = self.__values[column]
+        self.__codes[column].append( values.setdefault(value, len(values)) )
+
+
+    def add_page(self, page: Dict[str, Any]) -> None:
+        """
+        Appends the scrobbles of a user.getrecenttracks page to the column buffers.
+
+        Parameters:
+            page: The json of the page.
+
+        Returns:
+            None.
+        """
+        for scrobble in page['recenttracks']['track']:
+            # the track being played right now has no date yet and is not a scrobble
+            if 'date' not in scrobble:
+                continue
+
+            # the windows are fetched whole, so they may repeat the scrobbles already known
+            uts = int(scrobble['date']['uts'])
+            if self.__after_uts is not None and uts <= self.__after_uts:
+                continue
+
+            self.__append('Artist', scrobble['artist']['#text'])
+            self.__append('Album', scrobble['album']['#text'] or 'Last.fm Web Player')     # empty albums mean that the song was listened in the Last.fm Web Player
+            self.__append('Track', scrobble['name'])
+
+            self.__uts.append(uts)
+            self.last_uts = uts if self.last_uts is None else max(self.last_uts, uts)
+
+
+    def to_df(self, timezone_offset: int) -> pd.DataFrame:
+        """
+        Creates the dataframe with all the scrobbles added so far, sorted from the oldest to the newest scrobble.
+
+        Parameters:
+            timezone_offset: The user's time zone offset in hours, used to convert the Unix Timestamps to local times.
+
+        Returns:
+            A dataframe with the categorical columns Artist, Album and Track indexed by the local Date of each scrobble.
+        """
+        # the pages come from the newest to the oldest scrobble, so reversing them is usually enough... otherwise they are sorted (keeping the ties in order)
+        uts = np.frombuffer(self.__uts, dtype=np.int64)
+        order = np.arange(len(uts) - 1, -1, -1)
+        if np.any(np.diff(uts[order]) < 0):
+            order = order[ np.argsort(uts[order], kind='stable') ]
+
+        columns = {}
+        for column in ('Artist', 'Album', 'Track'):
+            categories: List[str] = list(self.__values[column])     # dicts keep insertion order, so the position of a value is its code
+            columns[column] = pd.Categorical.from_codes(np.frombuffer(self.__codes[column], dtype=np.int32)[order], categories=categories)
+
+        # converting the Unix Timestamps to local timezone times
+        local_seconds = uts[order] + timezone_offset * 3600
+        return pd.DataFrame(columns, index=pd.DatetimeIndex(pd.to_datetime(local_seconds, unit='s'), name='Date'))
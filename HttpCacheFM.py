@@ -0,0 +1,151 @@
+import sqlite3
+import zlib
+from threading import Lock
+from time import time
+from typing import Dict, Optional, Tuple
+
+class HttpCacheFM:
+    """
+    A bounded, expiring cache of the bodies of the responses sent by the Last.fm servers, kept in a sqlite file.
+    The bodies are stored compressed. Each entry either never expires (e.g. a closed window of the past) or expires after its time to live (e.g. a window touching the present).
+    When the stored bytes go over the size cap, the expired entries and then the least recently used ones are evicted.
+
+    Public instance variables:
+        path: The sqlite file of the cache.
+        max_bytes: The maximum number of (compressed) bytes kept.
+        hits: How many lookups found a fresh entry.
+        misses: How many lookups did not find a fresh entry.
+
+    Public methods:
+        get(): Returns the status code and the body cached for a key (or None).
+        put(): Caches the status code and the body of a key.
+        stats(): Returns the hits, misses, entries and bytes of the cache.
+        clear(): Removes all the entries.
+    """
+    def __init__(self, path: str = 'http_cache.sqlite', max_bytes: int = 256 * 2**20) -> None:
+        """
+        Opens (or creates) the cache file.
+
+        Parameters:
+            path: The sqlite file of the cache. Defaults to 'http_cache.sqlite'.
+            max_bytes: The maximum number of (compressed) bytes kept. Defaults to 256 MiB.
+
+        Returns:
+            None.
+        """
+        self.path = path
+        self.max_bytes = max(0, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.__evictions = 0
+
+        # a single connection shared by every thread using this object, serialized by the lock
+        self.__lock = Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, status INTEGER NOT NULL, body BLOB NOT NULL, size INTEGER NOT NULL, raw_size INTEGER NOT NULL, '
+            'expires REAL, accessed REAL NOT NULL)'
+        )
+        self.__connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+        # the expired entries of the previous runs are useless, so they are dropped right away
+        self.__connection.execute('DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?', (time(),))
+        self.__bytes = self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+
+    def __repr__(self) -> str:
+        """Returns the cache statistics."""
+        return 'HttpCacheFM(' + ', '.join( f'{name}={value}' for name, value in self.stats().items() ) + ')'
+
+
+    def get(self, key: str) -> Optional[Tuple[int, bytes]]:
+        """Returns the status code and the (decompressed) body cached for key and marks it as the most recently used, or None if it is not cached or expired."""
+        now = time()
+        with self.__lock:
+            row = self.__connection.execute('SELECT status, body, expires, size FROM responses WHERE key = ?', (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            # an expired entry is dropped, so its bytes are freed right away
+            if row[2] is not None and row[2] <= now:
+                self.misses += 1
+                self.__connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.__bytes -= row[3]
+                return None
+
+            self.hits += 1
+            self.__connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+
+        return row[0], zlib.decompress(row[1])
+
+
+    def put(self, key: str, status: int, body: bytes, ttl: Optional[float] = None) -> None:
+        """
+        Caches the status code and the body of key (replacing the previous entry, if any) and evicts entries if the cache goes over its size cap.
+
+        Parameters:
+            key: The key of the entry (e.g. the canonical query of the request).
+            status: The status code of the response.
+            body: The body of the response.
+            ttl: For how many seconds the entry is fresh. Defaults to None (it never expires).
+
+        Returns:
+            None.
+        """
+        compressed = zlib.compress(body, 6)
+        if len(compressed) > self.max_bytes:
+            return
+
+        now = time()
+        with self.__lock:
+            previous = self.__connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO responses (key, status, body, size, raw_size, expires, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, status, compressed, len(compressed), len(body), None if ttl is None else now + ttl, now)
+            )
+            self.__bytes += len(compressed) - (previous[0] if previous is not None else 0)
+
+            if self.__bytes > self.max_bytes:
+                self.__evict(now)
+
+
+    def __evict(self, now: float) -> None:
+        """Removes the expired entries and then the least recently used ones until the cache is back under its size cap. Must be called holding the lock."""
+        self.__evictions += self.__connection.execute('DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?', (now,)).rowcount
+
+        # walking the entries from the least to the most recently used one until enough bytes are freed
+        excess = self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0] - self.max_bytes
+        stale = []
+        for key, size in self.__connection.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if excess <= 0:
+                break
+            stale.append((key,))
+            excess -= size
+
+        self.__connection.executemany('DELETE FROM responses WHERE key = ?', stale)
+        self.__evictions += len(stale)
+        self.__bytes = self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the statistics of the cache.
+
+        Returns:
+            A dict with the hits, the misses, the evictions, how many entries are stored and how many bytes they take (compressed and decompressed).
+        """
+        with self.__lock:
+            entries, raw_bytes = self.__connection.execute('SELECT COUNT(*), COALESCE(SUM(raw_size), 0) FROM responses').fetchone()
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.__evictions, 'entries': entries, 'bytes': self.__bytes, 'raw_bytes': raw_bytes}
+
+
+    def clear(self) -> None:
+        """Removes all the entries (the hits and misses are kept)."""
+        with self.__lock:
+            self.__connection.execute('DELETE FROM responses')
+            self.__bytes = 0
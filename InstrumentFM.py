@@ -0,0 +1,244 @@
+import io
+import json
+import logging
+import os
+import tracemalloc
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, Union
+from LazyLoaderFM import LazyLoaderFM
+
+# the profilers are only imported by the first capture()
+cProfile = LazyLoaderFM('cProfile')
+pstats = LazyLoaderFM('pstats')
+
+class InstrumentFM:
+    """
+    Timers and counters of the hot paths: the requests to the Last.fm servers, the parsing of the pages, the building of the dataframe, the queries and the charts.
+    Each timed block is an event (its stage, labels such as the category, its duration and counters such as rows and bytes) that is aggregated per stage and labels and emitted to a sink.
+
+    Public instance variables:
+        sink: Where the events go: 'logging', 'jsonl', 'prometheus', a callable receiving each event, or None (only aggregated).
+        path: The file written by the 'jsonl' and 'prometheus' sinks.
+
+    Public methods:
+        timer(): Times a block and emits its event, with the counters the block adds to it.
+        observe(): Emits the event of a stage timed by the caller (e.g. only the network part of a request).
+        stats(): Returns the aggregates of each stage and labels (calls, seconds, counters and cache hit rate).
+        prometheus(): Returns the aggregates in the Prometheus text exposition format.
+        flush(): Writes the aggregates to the 'prometheus' sink file right away.
+        capture(): Profiles a block with cProfile and tracemalloc (opt-in, as both slow it down).
+        reset(): Drops the aggregates.
+    """
+    SINKS = ('logging', 'jsonl', 'prometheus')
+
+    def __init__(self, sink: Union[str, Callable[[Dict[str, Any]], None], None] = None, path: Optional[str] = None, interval: float = 5.0) -> None:
+        """
+        Constructs the instrument with no aggregates.
+
+        Parameters:
+            sink: Where the events go. 'logging' logs each event to the 'lastfm-analyzer' logger (INFO level), 'jsonl' appends each event as a json line to path,
+                'prometheus' rewrites path (e.g. for the node exporter textfile collector) with the aggregates. A callable receives each event dict. Defaults to None (only aggregated).
+            path: The file written by the 'jsonl' and 'prometheus' sinks. Defaults to None ('metrics.jsonl' or 'metrics.prom').
+            interval: The 'prometheus' sink rewrites its file at most once every this many seconds (see flush()). Defaults to 5.
+
+        Returns:
+            None.
+        """
+        if isinstance(sink, str) and sink not in self.SINKS:
+            raise ValueError(f"sink should be: 'logging', 'jsonl', 'prometheus' or a callable, but '{sink}' was passed.")
+
+        self.sink = sink
+        self.path = path if path is not None or not isinstance(sink, str) else {'logging': None, 'jsonl': 'metrics.jsonl', 'prometheus': 'metrics.prom'}[sink]
+        self.__interval = interval
+        self.__written = 0.0
+        self.__logger = logging.getLogger('lastfm-analyzer')
+
+        # the aggregates are updated by every thread using this object
+        self.__lock = Lock()
+        self.__aggregates: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Dict[str, float]] = {}
+
+
+    def __repr__(self) -> str:
+        """Returns the calls and seconds of each stage."""
+        return 'InstrumentFM(' + ', '.join( f"{name}={aggregate['calls']}x{aggregate['seconds']:.3f}s" for name, aggregate in self.stats().items() ) + ')'
+
+
+    @contextmanager
+    def timer(self, stage: str, **labels: str) -> Iterator[Dict[str, float]]:
+        """
+        Times the block and then emits its event. The block may add counters (e.g. rows, bytes, or cached as 0 or 1) to the dict it receives.
+
+        Parameters:
+            stage: The name of the timed stage (e.g. 'http', 'parse', 'top_by').
+            labels: Splits the aggregates of the stage (e.g. category='Artist'). Keep them few, as each combination is aggregated on its own.
+
+        Returns:
+            The dict of counters of the event, to be filled by the block.
+        """
+        counters: Dict[str, float] = {}
+        start = perf_counter()
+        try:
+            yield counters
+        finally:
+            self.__emit(stage, labels, perf_counter() - start, counters)
+
+
+    def observe(self, stage: str, seconds: float, counters: Optional[Dict[str, float]] = None, **labels: str) -> None:
+        """
+        Emits the event of a stage timed by the caller, for when only a part of a block should count as its duration (see timer()).
+
+        Parameters:
+            stage: The name of the timed stage (e.g. 'http').
+            seconds: The duration of the event.
+            counters: The counters of the event (e.g. rows, bytes, or cached as 0 or 1). Defaults to None (no counters).
+            labels: Splits the aggregates of the stage (e.g. method='user.getinfo').
+
+        Returns:
+            None.
+        """
+        self.__emit(stage, labels, seconds, counters if counters is not None else {})
+
+
+    def __emit(self, stage: str, labels: Dict[str, str], seconds: float, counters: Dict[str, float]) -> None:
+        """Adds the event to the aggregates of its stage and labels and hands it to the sink."""
+        key = (stage, tuple(sorted( (name, str(value)) for name, value in labels.items() )))
+
+        with self.__lock:
+            aggregate = self.__aggregates.setdefault(key, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            aggregate['calls'] += 1
+            aggregate['seconds'] += seconds
+            aggregate['max_seconds'] = max(aggregate['max_seconds'], seconds)
+            for name, value in counters.items():
+                aggregate[name] = aggregate.get(name, 0) + value
+
+            if self.sink is None:
+                return
+
+            event = {'stage': stage, **labels, 'seconds': round(seconds, 6), **counters, 'time': round(time(), 3)}
+
+            # the sinks are called holding the lock, so the lines of concurrent events are not interleaved
+            if callable(self.sink):
+                self.sink(event)
+            elif self.sink == 'logging':
+                self.__logger.info(json.dumps(event))
+            elif self.sink == 'jsonl' and self.path is not None:    # the file sinks always have a path (see __init__())
+                with open(self.path, 'a') as jsonl:
+                    jsonl.write(json.dumps(event) + '\n')
+            elif self.path is not None and perf_counter() - self.__written >= self.__interval:   # self.sink == 'prometheus'
+                self.__write_prometheus(self.path)
+
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the aggregates of each stage and labels.
+
+        Returns:
+            A dict keyed by the stage and its labels (e.g. 'top_by{category=Artist}') with the calls, the total and max seconds, the mean milliseconds, the summed counters
+            and, for the stages that count cached answers, the cache hit rate.
+        """
+        with self.__lock:
+            aggregates = { key: dict(aggregate) for key, aggregate in self.__aggregates.items() }
+
+        stats = {}
+        for (stage, labels), aggregate in sorted(aggregates.items()):
+            aggregate['mean_ms'] = aggregate['seconds'] / aggregate['calls'] * 1000
+            if 'cached' in aggregate:
+                aggregate['hit_rate'] = aggregate['cached'] / aggregate['calls']
+
+            name = stage + ('{' + ','.join( f'{label}={value}' for label, value in labels ) + '}' if labels else '')
+            stats[name] = aggregate
+
+        return stats
+
+
+    def prometheus(self) -> str:
+        """Returns the aggregates in the Prometheus text exposition format (a counter per aggregate, e.g. lastfm_analyzer_seconds_total{stage="http"})."""
+        with self.__lock:
+            return self.__exposition(self.__aggregates)
+
+
+    @staticmethod
+    def __exposition(aggregates: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Dict[str, float]]) -> str:
+        """Formats the aggregates in the Prometheus text exposition format."""
+        # grouping the samples of each metric, so each metric has a single TYPE line
+        samples: Dict[str, list] = {}
+        for (stage, labels), aggregate in sorted(aggregates.items()):
+            escaped = ( (label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in (('stage', stage),) + labels )
+            label_text = '{' + ','.join( f'{label}="{value}"' for label, value in escaped ) + '}'
+
+            for name, value in aggregate.items():
+                metric = 'lastfm_analyzer_' + (name if name == 'max_seconds' else f'{name}_total')
+                samples.setdefault(metric, []).append(f'{metric}{label_text} {value:g}')
+
+        lines = []
+        for metric, metric_samples in samples.items():
+            lines.append(f"# TYPE {metric} {'gauge' if metric.endswith('max_seconds') else 'counter'}")
+            lines.extend(metric_samples)
+
+        return '\n'.join(lines) + '\n'
+
+
+    def __write_prometheus(self, path: str) -> None:
+        """Rewrites the 'prometheus' sink file (path) with the aggregates (through a temporary file, so it is never read half written). Must be called holding the lock."""
+        with open(f'{path}.tmp', 'w') as prom:
+            prom.write(self.__exposition(self.__aggregates))
+        os.replace(f'{path}.tmp', path)
+        self.__written = perf_counter()
+
+
+    def flush(self) -> None:
+        """Writes the aggregates to the 'prometheus' sink file right away (the events only rewrite it once every interval)."""
+        if self.sink == 'prometheus' and self.path is not None:
+            with self.__lock:
+                self.__write_prometheus(self.path)
+
+
+    @contextmanager
+    def capture(self, name: str = 'capture', path: Optional[str] = None, top: int = 25) -> Iterator[Dict[str, Any]]:
+        """
+        Profiles the block with cProfile and traces its memory allocations with tracemalloc (both slow it down, so only use it to find out where the time goes).
+
+        Parameters:
+            name: The name of the captured block, emitted as the stage of its event (with its peak memory).
+            path: Where the cProfile stats are dumped (to be opened with pstats or snakeviz). Defaults to None (not dumped).
+            top: How many functions (by cumulative time) and allocation sites (by size) are reported. Defaults to 25.
+
+        Returns:
+            A dict filled when the block ends: 'profile' (the pstats report), 'memory' (the top allocation sites) and 'peak_bytes'.
+        """
+        report: Dict[str, Any] = {}
+        profiler = cProfile.Profile()
+        tracing = tracemalloc.is_tracing()  # someone else may be tracing already
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+
+        start = perf_counter()
+        profiler.enable()
+        try:
+            yield report
+        finally:
+            profiler.disable()
+            seconds = perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            report['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            if not tracing:
+                tracemalloc.stop()
+
+            # the functions that took the most time (including their callees) and the lines that allocated the most memory
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(top)
+            report['profile'] = text.getvalue()
+            report['memory'] = '\n'.join( str(statistic) for statistic in snapshot.statistics('lineno')[:top] )
+            if path is not None:
+                profiler.dump_stats(path)
+
+            self.__emit(name, {}, seconds, {'peak_bytes': report['peak_bytes']})
+
+
+    def reset(self) -> None:
+        """Drops the aggregates (the sink files are kept)."""
+        with self.__lock:
+            self.__aggregates.clear()
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+class LRUCacheFM:
+    """
+    A thread-safe, bounded cache that evicts the least recently used entries first.
+
+    Public instance variables:
+        maxsize: The maximum number of entries kept.
+        hits: How many lookups found their entry.
+        misses: How many lookups did not find their entry.
+
+    Public methods:
+        get(): Returns the value of a key (or None), counting the hit or the miss.
+        put(): Adds or replaces the value of a key, evicting the least recently used entry if full.
+        items(): Returns a snapshot of the entries, without marking them as used.
+        invalidate(): Removes the entries whose key matches a predicate.
+        clear(): Removes all the entries.
+    """
+    def __init__(self, maxsize: int = 256) -> None:
+        """
+        Constructs the empty cache.
+
+        Parameters:
+            maxsize: The maximum number of entries kept. Defaults to 256. Use 0 to disable the cache.
+
+        Returns:
+            None.
+        """
+        self.maxsize = max(0, maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+
+
+    def __len__(self) -> int:
+        """Returns how many entries are in the cache."""
+        return len(self.__entries)
+
+
+    def __repr__(self) -> str:
+        """Returns the cache statistics."""
+        return f'LRUCacheFM(hits={self.hits}, misses={self.misses}, maxsize={self.maxsize}, currsize={len(self)})'
+
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the value of key and marks it as the most recently used, or None if key is not in the cache."""
+        with self.__lock:
+            if key in self.__entries:
+                self.hits += 1
+                self.__entries.move_to_end(key)
+                return self.__entries[key]
+
+            self.misses += 1
+            return None
+
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Adds or replaces the value of key, evicting the least recently used entry if the cache is full."""
+        with self.__lock:
+            if self.maxsize == 0:
+                return
+
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+
+            if len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """Returns the (key, value) pairs of the cache, from the least to the most recently used, without counting hits or changing their order."""
+        with self.__lock:
+            return list(self.__entries.items())
+
+
+    def invalidate(self, predicate: Callable[[Any], bool]) -> int:
+        """Removes the entries whose key makes predicate return True and returns how many were removed."""
+        with self.__lock:
+            stale = [ key for key in self.__entries if predicate(key) ]
+            for key in stale:
+                del self.__entries[key]
+
+            return len(stale)
+
+
+    def clear(self) -> None:
+        """Removes all the entries (the hits and misses are kept)."""
+        with self.__lock:
+            self.__entries.clear()
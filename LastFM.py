@@ -1,46 +1,245 @@
-import requests
+from __future__ import annotations
 from datetime import datetime
 from datetime import date
-from time import mktime, localtime, gmtime
-from typing import Dict, Final
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+from random import uniform
+from threading import Lock
+from time import mktime, localtime, gmtime, perf_counter, sleep, time
+from typing import TYPE_CHECKING, Dict, Final, Optional, Tuple, Union
 from dotenv import dotenv_values
+from RateLimiterFM import RateLimiterFM
+from HttpCacheFM import HttpCacheFM
+from InstrumentFM import InstrumentFM
+from LazyLoaderFM import LazyLoaderFM
+
+# requests (and urllib3) are only imported when the first request is sent or the first cached response is rebuilt, so an offline analyzer never imports them
+if TYPE_CHECKING:
+    import requests
+else:
+    requests = LazyLoaderFM('requests')
 
 class LastFM:
     """
     An API to connect and fetch data from the Last.fm servers.
+    The requests share one keep-alive session (a pool of connections reused between requests and threads). Responses with a transient error (429 and 5xx) and failed connections are retried with exponential backoff.
 
     Public instance variables:
-        None.
+        cache: The cache of the responses (and its hits, misses and bytes), or None if the responses are not cached.
+        instrument: The timers and counters of the requests (the 'http' stage), shared with the AnalyzerFM using this object.
 
     Public methods:
         get_recent_tracks(): Gets the user's recent played tracks within the interval [from_date, to_date).
+        get_user_info(): Gets the user's profile information, such as the registration date.
+        stats(): Returns the request, retry and latency counters of this client.
     """
-    def __init__(self) -> None:
-        """Constructs all the necessary attributes for the LastFM object, such as the API keys and the time zone offset."""
+    RETRY_STATUS: Final = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, api_root: str = 'http://ws.audioscrobbler.com/2.0', requests_per_second: float = 4.0, cache_name: Optional[str] = 'http_cache',
+                 cache_max_bytes: int = 256 * 2**20, cache_ttl: float = 600.0, pool_size: int = 16, timeout: Tuple[float, float] = (5.0, 30.0), retries: int = 5, backoff: float = 0.5, max_backoff: float = 60.0,
+                 instrument: Optional[InstrumentFM] = None) -> None:
+        """
+        Constructs all the necessary attributes for the LastFM object, such as the API keys, the time zone offset and the HTTP session.
+
+        Parameters:
+            api_root: The API root URL location. Defaults to the Last.fm servers.
+            requests_per_second: How many requests per second can be sent to the servers. Defaults to 4 (one every 0.25 s).
+            cache_name: The sqlite file (without extension) where the responses are cached. Defaults to 'http_cache'. Use None to disable the cache.
+            cache_max_bytes: The maximum number of (compressed) bytes kept in the cache. Defaults to 256 MiB.
+            cache_ttl: For how many seconds the responses of a live window (the current month or the last day) are cached. Defaults to 600. The older windows are cached until evicted.
+            pool_size: How many connections are kept open to the servers. Defaults to 16 (should be at least the number of threads fetching pages).
+            timeout: The (connect, read) timeouts of each request, in seconds. Defaults to (5, 30).
+            retries: How many times a failed request is retried before giving up. Defaults to 5.
+            backoff: The base delay (in seconds) of the exponential backoff between retries. Defaults to 0.5.
+            max_backoff: The longest exponential backoff (in seconds) between retries. Defaults to 60. A longer Retry-After sent by the servers is still honored.
+            instrument: Where the requests are timed and counted. Defaults to a new InstrumentFM (only aggregated, see instrument.stats()).
+
+        Returns:
+            None.
+        """
         self.__config = dotenv_values('.env')
         self.__timezone_offset: Final = int( (mktime(localtime()) - mktime(gmtime())) / 3600 )
+        self.__api_root: Final = api_root
+        self.__rate_limiter = RateLimiterFM(requests_per_second)  # shared by every thread using this object
+        self.__timeout = timeout
+        self.__retries = max(0, retries)
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__cache_ttl = cache_ttl
+        self.cache = HttpCacheFM(f'{cache_name}.sqlite', cache_max_bytes) if cache_name is not None else None
+        self.instrument = instrument if instrument is not None else InstrumentFM()
+
+        # a single keep-alive session for all the requests, opened by the first one (see __connect())
+        self.__pool_size = max(1, pool_size)
+        self.__session: Optional[requests.Session] = None
+
+        # the counters (and the session) are updated by every thread using this object
+        self.__lock = Lock()
+        self.__stats = {'requests': 0, 'cached': 0, 'retries': 0, 'failures': 0, 'latency_total': 0.0, 'latency_max': 0.0}
 
 
     @property
     def timezone_offset(self) -> int:
         """A getter method for the timezone_offset attribute."""
         return self.__timezone_offset
-    
+
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the counters of this client.
+
+        Returns:
+            A dict with how many requests reached the servers, how many were answered by the cache, how many were retried, how many failed after all the retries and the mean and max latency (in seconds) of the requests that reached the servers.
+        """
+        with self.__lock:
+            stats = dict(self.__stats)
+
+        stats['latency_mean'] = stats['latency_total'] / stats['requests'] if stats['requests'] > 0 else 0.0
+        return stats
+
+
+    def __count(self, **increments: float) -> None:
+        """Adds the increments to the counters (the latency also updates the max latency)."""
+        with self.__lock:
+            for name, increment in increments.items():
+                self.__stats[name] += increment
+            if 'latency_total' in increments:
+                self.__stats['latency_max'] = max(self.__stats['latency_max'], increments['latency_total'])
+
+
+    def __delay(self, attempt: int, response: Optional[requests.models.Response]) -> float:
+        """Returns how long to wait before retrying: an exponential backoff with full jitter (at most max_backoff), but never shorter than the Retry-After header of the response (however long it is)."""
+        delay = uniform(0, min(self.__max_backoff, self.__backoff * 2**attempt))
+
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            # Retry-After is either a number of seconds or an HTTP date
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                try:
+                    delay = max(delay, parsedate_to_datetime(retry_after).timestamp() - time())
+                except (TypeError, ValueError):
+                    pass
+
+        return delay
+
+
+    def __live(self, payload: Dict[str, str]) -> bool:
+        """
+        Returns whether the response of the payload may still change, so it is only cached for cache_ttl seconds: the requests without a window (e.g. user.getinfo)
+        and the windows reaching the current month or the last day (the window of the current month ends at today's midnight, already in the past, but today's scrobbles arrive afterwards).
+        """
+        if 'to' not in payload:
+            return True
+
+        month_start = self.__date_seconds(date.today().replace(day=1).strftime('%Y-%m-%d'))
+        return int(payload['to']) >= min(month_start, time() - 86400)
+
+
+    def __from_cache(self, status: int, body: bytes) -> requests.models.Response:
+        """Rebuilds the Response of a cached body, marked with from_cache = True."""
+        response = requests.models.Response()
+        response.status_code = status
+        response._content = body
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json'
+        response.url = self.__api_root
+        response.from_cache = True # type: ignore
+        return response
+
 
     def __get(self, payload: Dict[str, str]) -> requests.models.Response:
-        """Returns the response from the Last.fm servers."""
-        url = 'http://ws.audioscrobbler.com/2.0'                # the API root URL location
-        my_header = {'User-Agent': 'lastfm-analyzer'}           # using an identifiable User-Agent header as noted in Last.fm docs
+        """
+        Returns the response from the Last.fm servers (or from the cache), emitted as an 'http' event with its bytes, its retries and whether it was cached.
+        The duration of the event is only the time spent on the network (or in the cache): the waits for the rate limiter and the backoffs between the retries
+        are counted apart, as wait_seconds and backoff_seconds.
+        """
+        counters: Dict[str, float] = {'cached': 0, 'retries': 0, 'network_seconds': 0.0, 'wait_seconds': 0.0, 'backoff_seconds': 0.0}
+        start = perf_counter()
+        try:
+            response = self.__request(payload, counters)
+            counters['bytes'] = len(response.content)
+        finally:
+            network_seconds = counters.pop('network_seconds')
+            seconds = network_seconds if not counters['cached'] else perf_counter() - start
+            self.instrument.observe('http', seconds, counters, method=payload['method'])
+
+        return response
 
-        # verifying if the returned value was not None (i.e. a str) beacuse dotenv_values() returns Optional[str]
-        if self.__config['API_KEY'] is not None:
-            payload['api_key'] = self.__config['API_KEY']       # adding the API KEY to the payload
-            payload['format'] = 'json'                          # adding the format of the response as json
 
-            return requests.get(url, headers=my_header, params=payload) # sending the request and returning its response
-        else:
+    def __connect(self) -> requests.Session:
+        """Returns the keep-alive session, opening it on the first call (so a client that never reaches the servers never imports requests)."""
+        with self.__lock:
+            if self.__session is None:
+                # the adapter does not retry by itself, the retries are done by __request()
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.__pool_size, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update({'User-Agent': 'lastfm-analyzer', 'Accept-Encoding': 'gzip'})   # using an identifiable User-Agent header as noted in Last.fm docs
+                self.__session = session
+
+            return self.__session
+
+
+    def __request(self, payload: Dict[str, str], counters: Dict[str, float]) -> requests.models.Response:
+        """Returns the response from the Last.fm servers (or from the cache), retrying the transient errors. The last response (or error) is returned (or raised) when the retries run out."""
+        # verifying if the returned value was not None (i.e. a str) beacuse dotenv_values() returns Optional[str]
+        if self.__config['API_KEY'] is None:
             raise Exception("dotenv_values() returned None")
 
+        # the cache key is the URL of the query without the API KEY, so the cached responses survive a new key (but the ones of another server, e.g. a stub, are never reused)
+        key = f'{self.__api_root}?{urlencode(sorted(payload.items()))}'
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.__count(cached=1)
+                counters['cached'] = 1
+                return self.__from_cache(*cached)
+
+        payload['api_key'] = self.__config['API_KEY']       # adding the API KEY to the payload
+        payload['format'] = 'json'                          # adding the format of the response as json
+
+        session = self.__connect()
+        attempt = 0
+        while True:
+            # every attempt (the cached responses were already returned) waits for a token, so all the threads together keep to requests_per_second
+            start = perf_counter()
+            self.__rate_limiter.acquire()
+            counters['wait_seconds'] += perf_counter() - start
+
+            response = None
+            start = perf_counter()
+            try:
+                response = session.get(self.__api_root, params=payload, timeout=self.__timeout) # sending the request
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                # the failed attempts are counted too (with the time they took), even the last one
+                if attempt == self.__retries:
+                    counters['network_seconds'] += perf_counter() - start
+                    self.__count(requests=1, latency_total=perf_counter() - start, failures=1)
+                    raise
+
+            counters['network_seconds'] += perf_counter() - start
+            self.__count(requests=1, latency_total=perf_counter() - start)
+
+            if response is not None and response.status_code not in self.RETRY_STATUS:
+                # a window that ended in the past will not change anymore, but the live ones still get new scrobbles
+                if self.cache is not None and response.status_code == 200:
+                    self.cache.put(key, response.status_code, response.content, ttl=self.__cache_ttl if self.__live(payload) else None)
+                return response
+            if attempt == self.__retries:
+                assert response is not None     # the connection errors of the last attempt were raised above
+                self.__count(failures=1)
+                return response
+
+            self.__count(retries=1)
+            counters['retries'] += 1
+            delay = self.__delay(attempt, response)
+            counters['backoff_seconds'] += delay
+            sleep(delay)
+            attempt += 1
+
 
     def __date_seconds(self, date_input: str) -> int:
         """Converts the date_input string ('YYYY-MM-DD') to the Unix Timestamp notation. The return value is in UTC time zone but taking the user's time zone into consideration."""
@@ -56,13 +255,13 @@ class LastFM:
         return int(local_seconds) - self.__timezone_offset*3600
             
 
-    def get_recent_tracks(self, user: str, from_date: str, to_date: str, limit: int = 50, page: int = 1) -> requests.models.Response:
+    def get_recent_tracks(self, user: str, from_date: Union[str, int], to_date: str, limit: int = 50, page: int = 1) -> requests.models.Response:
         """
         Gets the user's recent played tracks within the interval [from_date, to_date).
 
         Parameters:
             user: Last.fm username
-            from_date: String ('YYYY-MM-DD') to start from this day (closed interval).
+            from_date: String ('YYYY-MM-DD') to start from this day or Unix Timestamp (int) to start from this second (closed interval).
             to_date: String ('YYYY-MM-DD') to stop before this day (opened interval).
             limit: The number of results to fetch per page. Defaults to 50. Maximum is 200.
             page: The page number to fetch. Defaults to first page (1).
@@ -74,7 +273,7 @@ class LastFM:
         payload = {
             'method': 'user.getrecenttracks', 
             'user': user,
-            'from': str(self.__date_seconds(from_date)), 
+            'from': str(from_date if isinstance(from_date, int) else self.__date_seconds(from_date)),
             'to': str(self.__date_seconds(to_date) - 1),    # instead of 00:00:00, it is desired 23:59:59
             'limit': str( max(1, min(limit, 200)) ),
             'page': str(page)
@@ -83,6 +282,19 @@ class LastFM:
         return self.__get(payload)
 
 
+    def get_user_info(self, user: str) -> requests.models.Response:
+        """
+        Gets the user's profile information, such as the registration date.
+
+        Parameters:
+            user: Last.fm username
+
+        Returns:
+            The server response with the user's profile information.
+        """
+        return self.__get({'method': 'user.getinfo', 'user': user})
+
+
 if __name__ == '__main__':
     api = LastFM()
     response = api.get_recent_tracks('Vini_Bueno', '2019-01-01', '2020-01-01', limit=400)
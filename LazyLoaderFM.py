@@ -0,0 +1,47 @@
+import importlib
+import sys
+from types import ModuleType
+from typing import Any, Optional
+
+class LazyLoaderFM:
+    """
+    A stand-in for a module that is only imported when one of its attributes is first used, so the heavy dependencies that most runs never touch
+    (e.g. matplotlib when no chart is rendered, or requests when the analyzer is offline) do not slow down the startup.
+
+    Public instance variables:
+        name: The full name of the module (e.g. 'matplotlib.pyplot').
+
+    Public methods:
+        loaded(): Whether the module was already imported.
+    """
+    def __init__(self, name: str) -> None:
+        """
+        Constructs the stand-in without importing the module.
+
+        Parameters:
+            name: The full name of the module (e.g. 'matplotlib.pyplot').
+
+        Returns:
+            None.
+        """
+        self.name = name
+        self.__module: Optional[ModuleType] = None
+
+
+    def __getattr__(self, attribute: str) -> Any:
+        """Imports the module (on the first call only) and returns its attribute."""
+        # only called for the attributes the stand-in does not have itself, i.e. the ones of the module
+        if self.__module is None:
+            self.__module = importlib.import_module(self.name)    # the import system's lock makes this safe between threads
+
+        return getattr(self.__module, attribute)
+
+
+    def __repr__(self) -> str:
+        """Returns the name of the module and whether it was already imported."""
+        return f"LazyLoaderFM('{self.name}', loaded={self.loaded()})"
+
+
+    def loaded(self) -> bool:
+        """Returns whether the module was already imported (by this stand-in or by anyone else)."""
+        return self.__module is not None or self.name in sys.modules
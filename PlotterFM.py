@@ -1,14 +1,49 @@
 from AnalyzerFM import AnalyzerFM
-import matplotlib.pyplot as plt # type: ignore
+from LazyLoaderFM import LazyLoaderFM
+from StoreFM import StoreFM
 import pandas as pd # type: ignore
 import os # type: ignore
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Dict, Final, List, Optional
+
+# matplotlib is only imported when the first graph is drawn (pyplot, which also loads a GUI backend, only when a graph is shown)
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure # type: ignore
+backend_agg = LazyLoaderFM('matplotlib.backends.backend_agg')
+figure_module = LazyLoaderFM('matplotlib.figure')
+plt = LazyLoaderFM('matplotlib.pyplot')
+
+
+def render_user(user: str, year: str, output_dir: str, fmt: str, store_dir: str) -> Dict[str, str]:
+    """
+    Renders all the charts of a year of an already synced user (without any request) and saves them. Runs in the worker processes of PlotterFM.render_batch().
+
+    Parameters:
+        user: Last.fm username
+        year: the desired year in 'YYYY' format.
+        output_dir: The directory where the charts are saved.
+        fmt: The format of the charts, 'png' or 'svg'.
+        store_dir: The directory where the users' scrobbles are stored.
+
+    Returns:
+        A dict with the path of each chart. A user whose scrobbles were not stored yet raises a LookupError (instead of rendering empty charts).
+    """
+    if StoreFM(user, store_dir).schema() is None:
+        raise LookupError(f"the scrobbles of '{user}' were not stored yet.")
+
+    analyzer = AnalyzerFM(user, store_dir=store_dir, offline=True)
+    return PlotterFM(user, analyzer=analyzer, headless=True, output_dir=output_dir, fmt=fmt).render_year(year)
+
 
 class PlotterFM():
     """
     A plotter using matplotlib's methods to show the user's data in graphs.
+    A headless plotter never shows the graphs: it draws them on a single reused figure with the Agg backend (outside pyplot's global state) and saves them.
 
     Public instance variables:
-        None.
+        output_dir: The directory where the graphs are saved.
+        fmt: The format of the saved graphs, 'png' or 'svg'.
 
     Public methods:
         total_artists_year(): Shows a graph with the total number of artists listened that year by month.
@@ -16,137 +51,234 @@ class PlotterFM():
         total_tracks_year(): Shows a graph with the total number of tracks listened that year by month.
         total_scrobbles_year(): Shows a graph with the total number of scrobbles listened that year by month.
         most_listened_artists(): Shows a graph with the total number of scrobbles of the most listened artist in each month of that year.
+        render_year(): Saves all the graphs of that year, computed from the same monthly highlights.
+        render_batch(): Saves all the graphs of that year for many users, in worker processes.
     """
-    def __init__(self, user: str) -> None:
+    CHARTS: Final = ('total_artists_year', 'total_albums_year', 'total_tracks_year', 'total_scrobbles_year', 'most_listened_artists')
+    FORMATS: Final = ('png', 'svg')
+
+    def __init__(self, user: str, analyzer: Optional[AnalyzerFM] = None, headless: bool = False, output_dir: str = 'results', fmt: str = 'png') -> None:
         """
         Constructs the analyzer object with the user's data to be used by the Plotter. 
 
         Parameters:
             user: Last.fm username
+            analyzer: An AnalyzerFM already built for that user (e.g. offline). Defaults to None (a new one is built).
+            headless: Whether the graphs are only saved (and never shown). Defaults to False.
+            output_dir: The directory where the graphs are saved. Defaults to 'results/'.
+            fmt: The format of the saved graphs, 'png' or 'svg'. Defaults to 'png'.
 
         Returns:
             None.
         """
+        if fmt not in self.FORMATS:
+            raise ValueError(f"fmt should be: 'png' or 'svg', but '{fmt}' was passed.")
+
+        self.output_dir = output_dir
+        self.fmt = fmt
+
         # setting the private attributes
-        self.__analyzer = AnalyzerFM(user)
+        self.__analyzer = analyzer if analyzer is not None else AnalyzerFM(user)
         self.__months_names = 'Jan Feb Mar Apr May Jun Jul Agu Sep Oct Nov Dec'.split()
+        self.__years: Dict[str, pd.DataFrame] = {}     # the monthly highlights of each year already computed
+        self.__headless = headless
 
+        # a headless plotter draws every graph on the same figure, attached to an Agg canvas and not to pyplot (so it is freed with the plotter)... created with the first graph
+        self.__figure: Optional['Figure'] = None
 
-    def __render_barh(self, data: pd.DataFrame, title: str, xlabel: str, ylabel: str,  save_it: bool, color: str='salmon') -> None:
-        """Calls the barh() method from matplotlibs and customize it based upon the data passed."""
-        # setting graph size
-        plt.figure(figsize=(10, 5), facecolor='white')
 
-        # setting graph title and labels
-        plt.title(title)
-        plt.xlabel(xlabel)
-        plt.ylabel(ylabel)
+    def __months_of(self, year: str) -> pd.DataFrame:
+        """Returns the highlights of each month of that year, computing them all at once (and only once for all the graphs)."""
+        if year not in self.__years:
+            self.__years[year] = self.__analyzer.highlights_series('M', f'{year}-01-01', f'{int(year) + 1}-01-01')
 
-        # displaying the scrobbles counts
-        plt.barh(y=self.__months_names[::-1], width=data[::-1]['Count'], color=color)
-        for index, value in enumerate(data[::-1]['Count']):
-            plt.text(x=value+1, y=index-.2, s=str(value))
+        return self.__years[year]
 
-        # displaying the artist's name
-        if 'Artist' in data.columns:
-            for index, artist_name in enumerate(data[::-1]['Artist']):
-                plt.text(x=5, y=index-.2, s=artist_name)
 
-        # saving the graph if asked
-        if save_it == True:
-            if not os.path.isdir('results/'):
-                os.mkdir('results/')
-            plt.savefig(f'results/{title.replace(" ", "_").lower()}.png', facecolor='white')
+    def __headless_figure(self) -> 'Figure':
+        """Returns the figure reused by every graph of a headless plotter, creating it (and importing matplotlib) on the first call."""
+        if self.__figure is None:
+            self.__figure = figure_module.Figure(figsize=(10, 5), facecolor='white')
+            backend_agg.FigureCanvasAgg(self.__figure)
 
-        # displaying the graph
-        plt.show()
+        return self.__figure
 
 
-    def total_artists_year(self, year: str, save_it: bool=False) -> None:
+    def __render_barh(self, data: pd.DataFrame, title: str, xlabel: str, ylabel: str,  save_it: bool, color: str='salmon') -> Optional[str]:
+        """Draws a barh() graph on a matplotlib figure customized based upon the data passed, saves it if asked (always, if headless) and returns its path (or None)."""
+        # timing the rendering (and the saving) as the 'render' stage of the analyzer's instrument
+        with self.__analyzer.instrument.timer('render', saved=str(save_it or self.__headless)) as counters:
+            counters['rows'] = len(data)
+
+            # the headless figure is cleared and reused... otherwise a new figure is created by pyplot, so it can be shown
+            if self.__headless:
+                figure = self.__headless_figure()
+                figure.clear()
+            else:
+                figure = plt.figure(figsize=(10, 5), facecolor='white')
+            axes = figure.subplots()
+
+            # setting graph title and labels
+            axes.set_title(title)
+            axes.set_xlabel(xlabel)
+            axes.set_ylabel(ylabel)
+
+            # displaying the scrobbles counts
+            axes.barh(y=self.__months_names[::-1], width=data[::-1]['Count'], color=color)
+            for index, value in enumerate(data[::-1]['Count']):
+                axes.text(x=value+1, y=index-.2, s=str(value))
+
+            # displaying the artist's name
+            if 'Artist' in data.columns:
+                for index, artist_name in enumerate(data[::-1]['Artist']):
+                    axes.text(x=5, y=index-.2, s=artist_name)
+
+            # saving the graph if asked
+            path = None
+            if save_it or self.__headless:
+                os.makedirs(self.output_dir, exist_ok=True)
+                path = os.path.join(self.output_dir, f'{title.replace(" ", "_").lower()}.{self.fmt}')
+                figure.savefig(path, facecolor='white')
+
+            # displaying the graph and then releasing it from pyplot
+            if not self.__headless:
+                plt.show()
+                plt.close(figure)
+
+        return path
+
+
+    def total_artists_year(self, year: str, save_it: bool=False) -> Optional[str]:
         """
         Displays a graph with the total count of artists scrobbled in each month of that year.
 
         Parameters:
             year: the desired year in 'YYYY' format.
-            save_it: whether you wish to save the graph as am image or not.
+            save_it: whether you wish to save the graph as am image or not (a headless plotter always saves it).
 
         Returns:
-            None.
+            The path of the saved graph, or None if it was not saved.
         """
         # creating the dataframe with the total count of artists
-        total_artists = pd.DataFrame( [self.__analyzer.highlights_of('year', f'{year}-{month+1}').total_artists for month, _ in enumerate(self.__months_names)], columns={'Count'} )
+        total_artists = pd.DataFrame({'Count': self.__months_of(year)['total_artists']})
 
         # calling the renderer and displaying the graph to the user
-        self.__render_barh(data=total_artists, title=f'Total Artists Listened in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
+        return self.__render_barh(data=total_artists, title=f'Total Artists Listened in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
 
     
-    def total_albums_year(self, year: str, save_it: bool=False) -> None:
+    def total_albums_year(self, year: str, save_it: bool=False) -> Optional[str]:
         """
         Displays a graph with the total count of albums scrobbled in each month of that year.
 
         Parameters:
             year: the desired year in 'YYYY' format.
-            save_it: whether you wish to save the graph as am image or not.
+            save_it: whether you wish to save the graph as am image or not (a headless plotter always saves it).
 
         Returns:
-            None.
+            The path of the saved graph, or None if it was not saved.
         """
         # creating the dataframe with the total count of albums
-        total_albums = pd.DataFrame( [self.__analyzer.highlights_of('year', f'{year}-{month+1}').total_albums for month, _ in enumerate(self.__months_names)], columns={'Count'} )
+        total_albums = pd.DataFrame({'Count': self.__months_of(year)['total_albums']})
 
         # calling the renderer and displaying the graph to the user
-        self.__render_barh(data=total_albums, title=f'Total Albums Listened in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
+        return self.__render_barh(data=total_albums, title=f'Total Albums Listened in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
         
 
-    def total_tracks_year(self, year: str, save_it: bool=False) -> None:
+    def total_tracks_year(self, year: str, save_it: bool=False) -> Optional[str]:
         """
         Displays a graph with the total count of tracks scrobbled in each month of that year.
 
         Parameters:
             year: the desired year in 'YYYY' format.
-            save_it: whether you wish to save the graph as am image or not.
+            save_it: whether you wish to save the graph as am image or not (a headless plotter always saves it).
 
         Returns:
-            None.
+            The path of the saved graph, or None if it was not saved.
         """
         # creating the dataframe with the total count of tracks
-        total_tracks = pd.DataFrame( [self.__analyzer.highlights_of('year', f'{year}-{month+1}').total_tracks for month, _ in enumerate(self.__months_names)], columns={'Count'} )
+        total_tracks = pd.DataFrame({'Count': self.__months_of(year)['total_tracks']})
 
         # calling the renderer and displaying the graph to the user
-        self.__render_barh(data=total_tracks, title=f'Total Tracks in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
+        return self.__render_barh(data=total_tracks, title=f'Total Tracks in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
 
     
-    def total_scrobbles_year(self, year: str, save_it: bool=False) -> None:
+    def total_scrobbles_year(self, year: str, save_it: bool=False) -> Optional[str]:
         """
         Displays a graph with the total count of scrobbles in each month of that year.
 
         Parameters:
             year: the desired year in 'YYYY' format.
-            save_it: whether you wish to save the graph as am image or not.
+            save_it: whether you wish to save the graph as am image or not (a headless plotter always saves it).
 
         Returns:
-            None.
+            The path of the saved graph, or None if it was not saved.
         """
         # creating the dataframe with the total count of scrobbles
-        total_scrobbles = pd.DataFrame( [self.__analyzer.highlights_of('year', f'{year}-{month+1}').total_scrobbles for month, _ in enumerate(self.__months_names)], columns={'Count'} )
+        total_scrobbles = pd.DataFrame({'Count': self.__months_of(year)['total_scrobbles']})
 
         # calling the renderer and displaying the graph to the user
-        self.__render_barh(data=total_scrobbles, title=f'Total Scrobbles in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
+        return self.__render_barh(data=total_scrobbles, title=f'Total Scrobbles in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it)
 
 
-    def most_listened_artists(self, year: str, save_it: bool=False) -> None:
+    def most_listened_artists(self, year: str, save_it: bool=False) -> Optional[str]:
         """
         Displays a graph with the total count of scrobbles of the most listened artist in each month of that year.
 
         Parameters:
             year: the desired year in 'YYYY' format.
-            save_it: whether you wish to save the graph as am image or not.
+            save_it: whether you wish to save the graph as am image or not (a headless plotter always saves it).
 
         Returns:
-            None.
+            The path of the saved graph, or None if it was not saved.
         """
         # creating the dataframe with the most listened artists
-        top_artists = pd.DataFrame( [self.__analyzer.highlights_of('year', f'{year}-{month+1}').df_top_artist for month, _ in enumerate(self.__months_names)] ).reset_index(drop=True)
+        top_artists = self.__months_of(year)[['top_artist', 'top_artist_count']].set_axis(['Artist', 'Count'], axis='columns')
 
         # calling the renderer and displaying the graph to the user
-        self.__render_barh(data=top_artists, title=f'Most Listened Artists in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it, color='skyblue')
+        return self.__render_barh(data=top_artists, title=f'Most Listened Artists in {year}', xlabel='Total Scrobbles', ylabel='Months', save_it=save_it, color='skyblue')
+
+
+    def render_year(self, year: str) -> Dict[str, str]:
+        """
+        Saves all the graphs of that year (see CHARTS), all of them computed from the same monthly highlights.
+
+        Parameters:
+            year: the desired year in 'YYYY' format.
+
+        Returns:
+            A dict with the path of each graph.
+        """
+        return { chart: getattr(self, chart)(year, save_it=True) for chart in self.CHARTS }
+
+
+    @staticmethod
+    def render_batch(users: List[str], year: str, output_dir: str = 'results', fmt: str = 'png', processes: Optional[int] = None, store_dir: str = 'scrobbles') -> Dict[str, Dict[str, str]]:
+        """
+        Saves all the graphs of that year for each of the (already synced, see AnalyzerFM.sync()) users, rendered headless by worker processes.
+
+        Parameters:
+            users: The Last.fm usernames.
+            year: the desired year in 'YYYY' format.
+            output_dir: The directory where the graphs are saved, in a subdirectory per user. Defaults to 'results/'.
+            fmt: The format of the graphs, 'png' or 'svg'. Defaults to 'png'.
+            processes: How many worker processes render the graphs. Defaults to the number of CPUs.
+            store_dir: The directory where the users' scrobbles are stored. Defaults to 'scrobbles/'.
+
+        Returns:
+            A dict with the path of each graph of each user (or the error that stopped that user).
+        """
+        if fmt not in PlotterFM.FORMATS:
+            raise ValueError(f"fmt should be: 'png' or 'svg', but '{fmt}' was passed.")
+
+        # the workers are spawned (and not forked), so they do not inherit the state of pyplot
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = { user: executor.submit(render_user, user, year, os.path.join(output_dir, user), fmt, store_dir) for user in dict.fromkeys(users) }
+
+            charts: Dict[str, Dict[str, str]] = {}
+            for user, future in futures.items():
+                try:
+                    charts[user] = future.result()
+                except Exception as error:
+                    charts[user] = {'error': repr(error)}
+
+        return charts
@@ -0,0 +1,56 @@
+from threading import Lock
+from time import monotonic, sleep
+from typing import Optional
+
+class RateLimiterFM:
+    """
+    A thread-safe token bucket that limits how many requests per second are sent to the Last.fm servers.
+
+    Public instance variables:
+        rate: How many tokens are added to the bucket per second.
+        capacity: The maximum number of tokens the bucket can hold (i.e. the allowed burst).
+
+    Public methods:
+        acquire(): Blocks until a token is available and consumes it.
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        """
+        Constructs a full token bucket.
+
+        Parameters:
+            rate: How many tokens are added to the bucket per second. Must be greater than zero.
+            capacity: The maximum number of tokens the bucket can hold. Defaults to max(1, rate).
+
+        Returns:
+            None.
+        """
+        if rate <= 0:
+            raise ValueError(f"rate should be greater than zero, but '{rate}' was passed.")
+
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+
+        # the bucket starts full so the first requests are not delayed
+        self.__tokens = self.capacity
+        self.__last_refill = monotonic()
+        self.__lock = Lock()
+
+
+    def acquire(self) -> None:
+        """Blocks the calling thread until a token is available and then consumes it."""
+        while True:
+            with self.__lock:
+                # refilling the bucket with the tokens earned since the last refill
+                now = monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__last_refill) * self.rate)
+                self.__last_refill = now
+
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+
+                # how long until a whole token is available
+                wait = (1 - self.__tokens) / self.rate
+
+            # sleeping outside the lock so other threads can still check the bucket
+            sleep(wait)
@@ -0,0 +1,219 @@
+from typing import Callable, Dict, Optional, Tuple
+import numpy as np
+import pandas as pd # type: ignore
+
+class RollupFM:
+    """
+    A daily rollup of the scrobbles: how many times each Artist, (Album, Artist) and (Track, Artist) was scrobbled on each day, stored sparsely.
+    A range of whole days is counted by summing its day buckets, so it scales with the distinct keys and days in it and not with the scrobbles.
+
+    Each category is kept as a table of aligned arrays (one row per day and key) sorted from the oldest to the newest bucket:
+        Day: The local day of the bucket (days since 1970-01-01).
+        Artist, Album, Track: The categorical codes of the key. The Track table also has the Album of the most recent scrobble of that day.
+        Count: How many times the key was scrobbled on that day.
+
+    Public instance variables:
+        None.
+
+    Public methods:
+        update(): Recomputes the buckets of the days from a given date onwards.
+        merge(): Adds the buckets of other rollups (e.g. partial rollups of the chunks of a history) to this one.
+        count(): Counts how many times each key was scrobbled within a range of days.
+        table(): Returns the day buckets of a category.
+        count_rows(): Counts how many times each key appears in the given rows of codes.
+        tally(): Counts the distinct keys of an array, in order of first appearance.
+        days_of(): Converts a DatetimeIndex to days since 1970-01-01.
+    """
+    def __init__(self, df: pd.DataFrame) -> None:
+        """
+        Constructs the rollup of all the scrobbles in the given dataframe.
+
+        Parameters:
+            df: Dataframe with the scrobbles, sorted from the oldest to the newest one (as AnalyzerFM.df).
+
+        Returns:
+            None.
+        """
+        self.__tables: Dict[str, Dict[str, np.ndarray]] = {}
+        self.update(df)
+
+
+    @staticmethod
+    def days_of(index: pd.DatetimeIndex) -> np.ndarray:
+        """Converts a DatetimeIndex to days since 1970-01-01."""
+        return index.values.astype('datetime64[D]').astype(np.int64)
+
+
+    @staticmethod
+    def tally(keys: np.ndarray, weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Counts the distinct values of keys by hashing them (O(len(keys)), no sorting).
+
+        Parameters:
+            keys: The int64 keys to be counted.
+            weights: How much each key counts. Defaults to None (each one counts as 1).
+
+        Returns:
+            A tuple with the position of the first occurrence of each distinct key (in order of first appearance) and its count.
+        """
+        labels, uniques = pd.factorize(keys)
+        counts = np.bincount(labels, weights=weights, minlength=len(uniques)).astype(np.int64)
+
+        if len(labels) == 0:
+            return labels, counts
+
+        # the labels follow the order of first appearance, so a key shows up for the first time when the running max of the labels grows
+        running_max = np.maximum.accumulate(labels)
+        first = np.flatnonzero( np.concatenate([[True], running_max[1:] > running_max[:-1]]) )
+        return first, counts
+
+
+    @staticmethod
+    def __keys(artists: np.ndarray, titles: Optional[np.ndarray], total_artists: int) -> np.ndarray:
+        """Combines the artist codes (and the title codes, if any) into a single int64 key."""
+        if titles is None:
+            return artists.astype(np.int64)
+        return titles.astype(np.int64) * total_artists + artists
+
+
+    @staticmethod
+    def count_rows(rows: Dict[str, np.ndarray], category: str, weights: Optional[np.ndarray] = None) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        Counts how many times each Artist, (Album, Artist) or (Track, Artist) key appears in the given rows of codes.
+
+        Parameters:
+            rows: Aligned arrays with the codes of (at least) the Artist and the category columns, the most recent row first. With a 'Group' column, the keys are counted per group.
+            category: Can either be 'Artist', 'Album', or 'Track'.
+            weights: How much each row counts. Defaults to None (each one counts as 1).
+
+        Returns:
+            A tuple with the columns of each distinct key (taken from its first, i.e. most recent, row) and their counts.
+        """
+        if category not in ('Artist', 'Album', 'Track'):
+            raise ValueError(f"category should be: 'Artist', 'Album' or 'Track', but '{category}' was passed.")
+
+        total_artists = int(rows['Artist'].max()) + 1 if len(rows['Artist']) > 0 else 1
+        keys = RollupFM.__keys(rows['Artist'], None if category == 'Artist' else rows[category], total_artists)
+
+        # with groups, each (group, key) pair is counted on its own
+        if 'Group' in rows:
+            key_labels, key_uniques = pd.factorize(keys)
+            keys = rows['Group'].astype(np.int64) * len(key_uniques) + key_labels
+
+        first, counts = RollupFM.tally(keys, weights=weights)
+        return { column: rows[column][first] for column in rows if column not in ('Day', 'Count') }, counts
+
+
+    def __bucket(self, df: pd.DataFrame, days: np.ndarray, category: str) -> Dict[str, np.ndarray]:
+        """Computes the day buckets of a category for the given scrobbles (oldest first) and returns them from the oldest to the newest."""
+        # walking the scrobbles from the newest to the oldest one, so the first scrobble of each bucket is its most recent one
+        codes = { column: df[column].cat.codes.to_numpy()[::-1] for column in ('Artist', 'Album', 'Track') }
+        days = days[::-1]
+
+        # the songs that were listened in Last.fm Web Player do not count as albums
+        if category == 'Album':
+            listened = codes['Album'] != df['Album'].cat.categories.get_indexer(['Last.fm Web Player'])[0]
+            codes = { column: column_codes[listened] for column, column_codes in codes.items() }
+            days = days[listened]
+
+        keys = self.__keys(codes['Artist'], None if category == 'Artist' else codes[category], len(df['Artist'].cat.categories))
+
+        # a bucket is a (day, key) pair... the days never grow from one scrobble to the next, so their offset from the first day is enough to tell them apart
+        key_labels, key_uniques = pd.factorize(keys)
+        first, counts = self.tally( (days[0] - days) * len(key_uniques) + key_labels if len(days) > 0 else key_labels )
+
+        # the Track table keeps the album of the newest scrobble of the day
+        columns = {'Artist': ['Artist'], 'Album': ['Artist', 'Album'], 'Track': ['Artist', 'Track', 'Album']}[category]
+        table = { column: codes[column][first][::-1] for column in columns }
+        table['Day'] = days[first][::-1]
+        table['Count'] = counts[::-1]
+        return table
+
+
+    def update(self, df: pd.DataFrame, since: Optional[pd.Timestamp] = None) -> None:
+        """
+        Recomputes the buckets of the days from the given date onwards, keeping the older ones. The categories of df must keep the codes of the older buckets.
+
+        Parameters:
+            df: Dataframe with the scrobbles, sorted from the oldest to the newest one (as AnalyzerFM.df).
+            since: The date of the oldest new scrobble. Defaults to None (all the buckets are recomputed).
+
+        Returns:
+            None.
+        """
+        since_day = None if since is None or not self.__tables else pd.Timestamp(since).normalize()
+
+        # the scrobbles of the days being recomputed are at the bottom of the dataframe
+        recent = 0 if since_day is None else int(df.index.searchsorted(since_day, side='left'))
+        days = self.days_of(df.index[recent:])
+
+        for category in ('Artist', 'Album', 'Track'):
+            table = self.__bucket(df.iloc[recent:], days, category)
+
+            if since_day is not None:
+                kept = int(np.searchsorted(self.__tables[category]['Day'], self.days_of(pd.DatetimeIndex([since_day]))[0], side='left'))
+                table = { column: np.concatenate([self.__tables[category][column][:kept], table[column]]) for column in table }
+
+            self.__tables[category] = table
+
+
+    def merge(self, *others: 'RollupFM') -> None:
+        """
+        Adds the buckets of other rollups to this one, summing the buckets of the same day and key. This way a history can be rolled up chunk by chunk.
+
+        Parameters:
+            others: The rollups to be added. They must share the categories of this one (the newer ones may have extra categories at the end) and come from the oldest to the newest, none of them older than this one.
+
+        Returns:
+            None.
+        """
+        for category in self.__tables:
+            tables = [self.__tables[category]] + [ other.__tables[category] for other in others ]
+
+            # walking the buckets from the newest to the oldest one, so a (day, key) found in two rollups keeps its newest bucket (and its Album, for the tracks)
+            rows = { column: np.concatenate([ table[column] for table in tables ])[::-1] for column in tables[0] }
+            if len(rows['Day']) == 0:
+                continue
+
+            keys = self.__keys(rows['Artist'], None if category == 'Artist' else rows[category], int(rows['Artist'].max()) + 1)
+            key_labels, key_uniques = pd.factorize(keys)
+            first, counts = self.tally( (rows['Day'] - rows['Day'].min()) * len(key_uniques) + key_labels, weights=rows['Count'] )
+
+            table = { column: rows[column][first][::-1] for column in rows if column != 'Count' }
+            table['Count'] = counts[::-1]
+            self.__tables[category] = table
+
+
+    def table(self, category: str) -> Dict[str, np.ndarray]:
+        """Returns the day buckets of the category (as described above). The arrays are not copied, so they must not be changed."""
+        if category not in self.__tables:
+            raise ValueError(f"category should be: 'Artist', 'Album' or 'Track', but '{category}' was passed.")
+
+        return self.__tables[category]
+
+
+    def count(self, start_day: int, end_day: int, category: str, groups: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """
+        Counts how many times each key of the category was scrobbled within the days [start_day, end_day).
+
+        Parameters:
+            start_day: The first day (days since 1970-01-01) of the range.
+            end_day: The day (days since 1970-01-01) right after the range.
+            category: Can either be 'Artist', 'Album', or 'Track'.
+            groups: A function mapping an array of days to their group ids (e.g. their months), so the keys are counted per group. Defaults to None (a single group).
+
+        Returns:
+            A tuple with the codes of the columns of each distinct key (the most recently scrobbled first) and their counts. With groups, the codes also have a 'Group' column.
+        """
+        if category not in self.__tables:
+            raise ValueError(f"category should be: 'Artist', 'Album' or 'Track', but '{category}' was passed.")
+
+        # the buckets are sorted by day, so the range is a contiguous block of them... walked from the newest to the oldest
+        table = self.__tables[category]
+        start, end = np.searchsorted(table['Day'], [start_day, end_day], side='left')
+        rows = { column: table[column][start:end][::-1] for column in table }
+
+        if groups is not None:
+            rows['Group'] = groups(rows['Day'])
+
+        return self.count_rows(rows, category, weights=rows['Count'])
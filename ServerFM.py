@@ -0,0 +1,390 @@
+from AnalyzerFM import AnalyzerFM
+from LastFM import LastFM
+from LRUCacheFM import LRUCacheFM
+from LazyLoaderFM import LazyLoaderFM
+from PlotterFM import PlotterFM
+from StoreFM import StoreFM
+from contextlib import contextmanager
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from typing import Any, Dict, Iterator, List, Optional, Tuple, cast
+from urllib.parse import parse_qs, urlparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import numpy as np
+import pandas as pd # type: ignore
+
+# requests is only needed to tell the failed requests to the Last.fm servers apart (see LastFM)
+requests = LazyLoaderFM('requests')
+
+class ServerFM:
+    """
+    A long-running local HTTP service answering the queries (as json) and the charts (as png or svg) of many users from analyzers kept warm in memory.
+    The analyzers of the most recently queried users are kept (the least recently used one is dropped when there are too many) and their new scrobbles are fetched in the background.
+    Each request is served by its own thread: the requests of the same user take turns (behind a lock per user) and the ones of different users run at the same time.
+
+    Endpoints (GET, unless noted):
+        /health: The status of the server and its warm users.
+        /metrics: The timers and counters of every stage (requests, queries, charts and the server itself) in the Prometheus text exposition format.
+        /users/<user>/top_by?period=&date=&category=[&n=]: AnalyzerFM.top_by(), as a list of records.
+        /users/<user>/top_between?start=&end=&category=[&n=]: AnalyzerFM.top_between(), as a list of records.
+        /users/<user>/highlights_of?period=&date=: AnalyzerFM.highlights_of(), as an object.
+        /users/<user>/summary_highlights?period=&date=: AnalyzerFM.summary_highlights(), as {"summary": text}.
+        /users/<user>/charts/<chart>[.png|.svg]?year=: A chart of PlotterFM.CHARTS (e.g. total_scrobbles_year), as an image.
+        /users/<user>/refresh (POST): Fetches the user's new scrobbles right away, as {"new_scrobbles": n}. An offline server reloads the user's store instead.
+
+    Public instance variables:
+        api: The LastFM object shared by every analyzer (and so its rate limit, its cache of responses and its instrument).
+        analyzers: The LRU cache with the warm AnalyzerFM of each user (and its hits and misses).
+        url: The root URL of the server (e.g. http://127.0.0.1:8080).
+
+    Public methods:
+        start(): Starts serving (and refreshing the warm users) in background threads.
+        stop(): Stops serving and releases the socket.
+        serve_forever(): Starts serving and blocks until interrupted (Ctrl+C).
+        respond(): Answers a single request, without any socket.
+        refresh_all(): Fetches the new scrobbles of every warm user.
+    """
+    QUERIES = ('top_by', 'top_between', 'highlights_of', 'summary_highlights')
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8080, max_users: int = 8, offline: bool = False, refresh_interval: float = 600.0, store_dir: str = 'scrobbles',
+                 cache_size: int = 256, chart_dir: Optional[str] = None, max_workers: int = 4, api: Optional[LastFM] = None) -> None:
+        """
+        Constructs the server and binds its socket, without serving yet (see start() and serve_forever()).
+
+        Parameters:
+            host: The address the server listens on. Defaults to '127.0.0.1' (only this machine).
+            port: The port the server listens on. Defaults to 8080. Use 0 to pick any free port (see url).
+            max_users: How many users are kept warm in memory. Defaults to 8.
+            offline: Whether to only answer from the stored scrobbles (e.g. kept up to date by AnalyzerFM.sync()), without requesting anything to the Last.fm servers. Defaults to False.
+            refresh_interval: Every how many seconds the new scrobbles of the warm users are fetched in the background. Defaults to 600. Use 0 to never refresh them.
+                NOTE: the scrobbles are fetched up to the end of yesterday (as by AnalyzerFM), so the ones of today only show up after midnight. And LastFM caches the responses of the
+                current month for its cache_ttl (600 s by default), so a refresh within that time of the previous one gets no new scrobbles.
+            store_dir: The directory where the users' scrobbles are stored. Defaults to 'scrobbles/'.
+            cache_size: How many results of top_by() and highlights_of() each analyzer keeps in memory. Defaults to 256.
+            chart_dir: The directory where the charts are saved, in a subdirectory per user. Defaults to None (a temporary directory, removed by stop()).
+            max_workers: The maximum number of pages of a user fetched concurrently. Defaults to 4.
+            api: The LastFM object used to fetch the pages. Defaults to a new one.
+
+        Returns:
+            None.
+        """
+        self.api = api if api is not None else LastFM()
+        self.analyzers = LRUCacheFM(max(1, max_users))
+        self.__offline = offline
+        self.__refresh_interval = refresh_interval
+        self.__store_dir = store_dir
+        self.__cache_size = cache_size
+        self.__max_workers = max_workers
+        self.__logger = logging.getLogger('lastfm-analyzer')
+
+        # the charts are saved before being served, in a temporary directory if none was given
+        self.__temporary_dir = tempfile.TemporaryDirectory() if chart_dir is None else None
+        self.__chart_dir = chart_dir if chart_dir is not None else self.__temporary_dir.name  # type: ignore
+
+        # a lock per user makes the requests of that user take turns, as an analyzer must not be queried while it is refreshed (or built)...
+        # each lock only lives while its user has requests in flight (see __locked()). And matplotlib is not thread-safe, so the charts are drawn one at a time
+        self.__locks: Dict[str, List[Any]] = {}    # the lock of each user and how many threads hold it or wait for it
+        self.__locks_lock = Lock()
+        self.__render_lock = Lock()
+        self.__stopping = Event()
+        self.__threads: List[Thread] = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'   # keeping the connections of the dashboards alive
+
+            def do_GET(self) -> None:
+                self.reply('GET')
+
+            def do_POST(self) -> None:
+                # the body of a POST is not used, but it is read so the connection can be reused
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.reply('POST')
+
+            def reply(self, method: str) -> None:
+                status, content_type, body = server.respond(method, self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                logging.getLogger('lastfm-analyzer').debug(format, *args)
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        # the address the socket was bound to (with port 0, the free port that was picked)... typeshed also allows a bytes host, which a TCP socket never has
+        bound_host, bound_port = self.__server.server_address[:2]
+        self.url = f"http://{bound_host if isinstance(bound_host, str) else bound_host.decode()}:{bound_port}"
+
+
+    def __repr__(self) -> str:
+        """Returns the URL of the server and its warm users."""
+        return f"ServerFM(url='{self.url}', users={[ user for user, _ in self.analyzers.items() ]}, offline={self.__offline})"
+
+
+    @contextmanager
+    def __locked(self, user: str) -> Iterator[None]:
+        """
+        Holds the lock of the user. The lock is created by the first thread that needs it and dropped by the last one,
+        so there are only locks for the users with requests in flight (and not for every username ever requested).
+        """
+        with self.__locks_lock:
+            entry = self.__locks.setdefault(user, [Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.__locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.__locks[user]
+
+
+    @contextmanager
+    def __warm(self, user: str) -> Iterator[AnalyzerFM]:
+        """Holds the user's lock and returns the user's warm analyzer, building it on the first request of that user (or after it was dropped by the LRU cache)."""
+        with self.__locked(user):
+            analyzer = self.analyzers.get(user)
+            if analyzer is None:
+                if self.__offline and StoreFM(user, self.__store_dir).schema() is None:
+                    raise LookupError(f"the scrobbles of '{user}' were not stored yet.")
+
+                analyzer = AnalyzerFM(user, max_workers=self.__max_workers, api=self.api, store_dir=self.__store_dir, cache_size=self.__cache_size, offline=self.__offline,
+                                      progress=False)
+                self.analyzers.put(user, analyzer)
+
+            yield analyzer
+
+
+    @staticmethod
+    def __param(query: Dict[str, str], name: str) -> str:
+        """Returns a required parameter of the query string, if it is missing a ValueError is raised."""
+        if name not in query:
+            raise ValueError(f"the parameter '{name}' should be passed, but it was not.")
+        return query[name]
+
+
+    @staticmethod
+    def __category(query: Dict[str, str]) -> str:
+        """Returns the category of the query string, if it is not valid a ValueError is raised."""
+        category = ServerFM.__param(query, 'category')
+        if category not in ('Artist', 'Album', 'Track'):
+            raise ValueError(f"category should be: 'Artist', 'Album' or 'Track', but '{category}' was passed.")
+        return category
+
+
+    @staticmethod
+    def __json(payload: Any) -> Tuple[int, str, bytes]:
+        """Returns the OK status, the content type and the body of a json payload (with the numpy and pandas values converted)."""
+        def convert(value: Any) -> Any:
+            if isinstance(value, np.generic):
+                return value.item()
+            if isinstance(value, pd.Series):
+                return value.to_dict()
+            if isinstance(value, pd.Timestamp):
+                return value.isoformat()
+            raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+        return 200, 'application/json', json.dumps(payload, default=convert).encode()
+
+
+    def respond(self, method: str, target: str) -> Tuple[int, str, bytes]:
+        """
+        Answers a single request (see the endpoints of the class), timed as the 'serve' stage of the api's instrument.
+
+        Parameters:
+            method: The HTTP method, 'GET' or 'POST'.
+            target: The path and query string of the request (e.g. '/users/Vini_Bueno/top_by?period=year&date=2021&category=Artist&n=5').
+
+        Returns:
+            The HTTP status, the content type and the body of the response. The errors are json objects with an 'error' message.
+        """
+        url = urlparse(target)
+        query = { name: values[-1] for name, values in parse_qs(url.query).items() }
+        parts = [ part for part in url.path.split('/') if part ]
+
+        # the endpoint (and not the whole path) labels the timer, so there are only a few aggregates
+        endpoint = parts[2] if len(parts) >= 3 and parts[0] == 'users' else '/'.join(parts[:1])
+        with self.api.instrument.timer('serve', endpoint=endpoint if endpoint in self.QUERIES + ('charts', 'refresh', 'health', 'metrics') else 'unknown') as counters:
+            try:
+                status, content_type, body = self.__route(method, parts, query)
+            except Exception as error:
+                status = self.__status(error)
+                if status == 500:
+                    self.__logger.exception(f'{method} {target} failed')
+                content_type, body = 'application/json', json.dumps({'error': str(error) if status != 500 else repr(error)}).encode()
+
+            counters.update(errors=int(status >= 400), bytes=len(body))
+
+        return status, content_type, body
+
+
+    @staticmethod
+    def __status(error: Exception) -> int:
+        """Returns the HTTP status of a failed request: 400 for a bad parameter, 404 for an unknown endpoint or user, 502 if the Last.fm servers failed and 500 otherwise."""
+        if isinstance(error, ValueError):
+            return 400
+
+        # only the unknown endpoints and users raise a bare LookupError... a KeyError or an IndexError is a bug
+        if type(error) is LookupError:
+            return 404
+
+        # the Last.fm servers failed (or refused the user), even after the client's retries
+        if isinstance(error, requests.RequestException):
+            return 502
+
+        return 500
+
+
+    def __route(self, method: str, parts: List[str], query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        """Answers the request of the endpoint of the path parts. An unknown endpoint or user raises a LookupError and a bad parameter a ValueError."""
+        if method == 'GET' and parts == ['health']:
+            return self.__json({'status': 'ok', 'offline': self.__offline, 'users': [ user for user, _ in self.analyzers.items() ]})
+
+        if method == 'GET' and parts == ['metrics']:
+            return 200, 'text/plain; version=0.0.4', self.api.instrument.prometheus().encode()
+
+        if len(parts) < 3 or parts[0] != 'users':
+            raise LookupError(f"there is no endpoint '{method} /{'/'.join(parts)}'.")
+
+        # the username becomes the name of the user's store, so it must be a valid Last.fm username (and not a path)
+        user = parts[1]
+        if re.fullmatch(r'[A-Za-z0-9_-]{1,15}', user) is None:
+            raise ValueError(f"user should be: a Last.fm username (up to 15 letters, digits, '_' or '-'), but '{user}' was passed.")
+
+        if method == 'POST' and parts[2:] == ['refresh']:
+            return self.__json(self.__refresh(user))
+
+        if method == 'GET' and len(parts) == 4 and parts[2] == 'charts':
+            return self.__chart(user, parts[3], query)
+
+        if method == 'GET' and len(parts) == 3 and parts[2] in self.QUERIES:
+            return self.__json(self.__query(user, parts[2], query))
+
+        raise LookupError(f"there is no endpoint '{method} /{'/'.join(parts)}'.")
+
+
+    def __query(self, user: str, endpoint: str, query: Dict[str, str]) -> Any:
+        """Answers one of the QUERIES of the user's analyzer, as a json payload."""
+        if 'n' in query and re.fullmatch(r'\d+', query['n']) is None:
+            raise ValueError(f"n should be: a positive integer, but '{query['n']}' was passed.")
+        n = int(query['n']) if 'n' in query else None
+
+        with self.__warm(user) as analyzer:
+            if endpoint == 'top_by':
+                return analyzer.top_by(self.__param(query, 'period'), self.__param(query, 'date'), self.__category(query), n=n).to_dict('records')
+
+            elif endpoint == 'top_between':
+                return analyzer.top_between(self.__param(query, 'start'), self.__param(query, 'end'), self.__category(query), n=n).to_dict('records')
+
+            elif endpoint == 'highlights_of':
+                return asdict(analyzer.highlights_of(self.__param(query, 'period'), self.__param(query, 'date')))
+
+            else: # endpoint == 'summary_highlights'
+                return {'summary': analyzer.summary_highlights(self.__param(query, 'period'), self.__param(query, 'date'))}
+
+
+    def __chart(self, user: str, name: str, query: Dict[str, str]) -> Tuple[int, str, bytes]:
+        """Draws a chart of the user's analyzer (the format comes from the extension of its name, png by default) and returns the OK status, its content type and the image."""
+        chart, _, fmt = name.partition('.')
+        if chart not in PlotterFM.CHARTS:
+            raise LookupError(f"chart should be: {', '.join(repr(chart) for chart in PlotterFM.CHARTS)}, but '{chart}' was passed.")
+
+        year = self.__param(query, 'year')
+        if re.fullmatch(r'\d{4}', year) is None:
+            raise ValueError(f"year should be: 'YYYY', but '{year}' was passed.")
+
+        # a new plotter for every chart, so its monthly highlights are never older than the analyzer's scrobbles
+        with self.__warm(user) as analyzer, self.__render_lock:
+            plotter = PlotterFM(user, analyzer=analyzer, headless=True, output_dir=os.path.join(self.__chart_dir, user), fmt=fmt or 'png')
+            with open(getattr(plotter, chart)(year), 'rb') as image:
+                body = image.read()
+
+        return 200, 'image/svg+xml' if plotter.fmt == 'svg' else 'image/png', body
+
+
+    def __refresh(self, user: str) -> Dict[str, Any]:
+        """Fetches the new scrobbles of a warm user (building its analyzer if it was not warm). An offline server drops the user's analyzer instead, so its store is reloaded by the next request."""
+        if self.__offline:
+            with self.__locked(user):
+                return {'reloaded': self.analyzers.invalidate(lambda key: key == user) > 0}
+
+        with self.__warm(user) as analyzer:
+            return {'new_scrobbles': analyzer.refresh()}
+
+
+    def refresh_all(self) -> Dict[str, int]:
+        """
+        Fetches the new scrobbles of every warm user, one user at a time (the requests of the other users are still answered meanwhile).
+
+        Returns:
+            A dict with how many new scrobbles each warm user got. The users whose refresh failed are logged and left out.
+        """
+        new_scrobbles: Dict[str, int] = {}
+        for key, analyzer in self.analyzers.items():
+            user = cast(str, key)   # the analyzers are keyed by username
+            try:
+                with self.__locked(user):
+                    new_scrobbles[user] = analyzer.refresh()
+            except Exception:
+                self.__logger.exception(f'refreshing {user} failed')
+
+        return new_scrobbles
+
+
+    def __refresh_loop(self) -> None:
+        """Refreshes the warm users every refresh_interval seconds, until the server stops."""
+        while not self.__stopping.wait(self.__refresh_interval):
+            with self.api.instrument.timer('refresh_all') as counters:
+                counters['rows'] = sum(self.refresh_all().values())
+
+
+    def start(self) -> None:
+        """Starts serving in a background (daemon) thread and, unless offline, refreshing the warm users in another one."""
+        self.__stopping.clear()
+        self.__threads = [Thread(target=self.__server.serve_forever, daemon=True)]
+        if not self.__offline and self.__refresh_interval > 0:
+            self.__threads.append(Thread(target=self.__refresh_loop, daemon=True))
+
+        for thread in self.__threads:
+            thread.start()
+
+
+    def stop(self) -> None:
+        """Stops serving (and refreshing), releases the socket and removes the temporary chart directory."""
+        self.__stopping.set()
+        self.__server.shutdown()
+        self.__server.server_close()
+        for thread in self.__threads:
+            thread.join()
+
+        if self.__temporary_dir is not None:
+            self.__temporary_dir.cleanup()
+
+
+    def serve_forever(self) -> None:
+        """Starts serving and blocks until interrupted (Ctrl+C), then stops."""
+        self.start()
+        print(f'Serving on {self.url} (Ctrl+C to stop)')
+        try:
+            self.__stopping.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+if __name__ == '__main__':
+    # usage: python ServerFM.py [port] [--offline]
+    ServerFM(port=int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 8080, offline='--offline' in sys.argv).serve_forever()
@@ -0,0 +1,209 @@
+import json
+import os
+from typing import Any, Dict, Iterator, Optional, Tuple
+import numpy as np
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.feather as feather # type: ignore
+
+class StoreFM:
+    """
+    A persistent, per-user store of the scrobbles already fetched from Last.fm.
+    The scrobbles are kept in a columnar (Feather) file: Artist, Album and Track are dictionary encoded and Date is an int64 of seconds.
+
+    Public instance variables:
+        user: Last.fm username.
+        directory: The directory where the stores are kept.
+
+    Public methods:
+        load(): Loads the stored dataframe and the timestamp of its newest scrobble.
+        schema(): Loads an empty dataframe with the stored categories and the timestamp of its newest scrobble.
+        scan(): Loads the stored dataframe chunk by chunk.
+        save(): Saves the dataframe and the timestamp of its newest scrobble.
+        append(): Appends newer scrobbles to the store without loading it.
+    """
+    def __init__(self, user: str, directory: str = 'scrobbles') -> None:
+        """
+        Constructs the path of the user's store. Nothing is read or written yet.
+
+        Parameters:
+            user: Last.fm username
+            directory: The directory where the stores are kept. Defaults to 'scrobbles/'.
+
+        Returns:
+            None.
+        """
+        self.user = user
+        self.directory = directory
+        self.__path = os.path.join(directory, f'{user}.feather')
+
+
+    def __read(self) -> Optional[Tuple[pa.Table, Dict[str, Any]]]:
+        """Memory-maps the user's store and returns its table and its metadata, or None if nothing was stored yet."""
+        if not os.path.isfile(self.__path):
+            return None
+
+        table = feather.read_table(self.__path, memory_map=True)
+        return table, json.loads(table.schema.metadata[b'lastfm-analyzer'])
+
+
+    @staticmethod
+    def __table(df: pd.DataFrame, meta: Dict[str, Any]) -> pa.Table:
+        """Converts the dataframe to the table written to the store: the Date as seconds, the strings as categoricals (i.e. dictionary encoded) and the metadata in the schema."""
+        columns = pd.DataFrame({ column: df[column].astype('category') for column in ('Artist', 'Album', 'Track') })
+        columns['Date'] = df.index.values.astype('datetime64[s]').astype(np.int64)
+
+        table = pa.Table.from_pandas(columns, preserve_index=False)
+        return table.replace_schema_metadata({ **table.schema.metadata, b'lastfm-analyzer': json.dumps(meta).encode() })
+
+
+    def load(self) -> Optional[Tuple[pd.DataFrame, int]]:
+        """
+        Loads the user's store. The file is memory-mapped, so no json or date string is parsed.
+
+        Returns:
+            A tuple with the stored dataframe and the Unix Timestamp of its newest scrobble, or None if nothing was stored yet.
+        """
+        read = self.__read()
+        if read is None:
+            return None
+        table, meta = read
+
+        # the dictionary encoded columns come back as categoricals
+        df = table.to_pandas()
+
+        # converting the Date column from int64 seconds back to datetime64 and setting it as index
+        df['Date'] = pd.to_datetime(df['Date'], unit='s')
+        df.set_index('Date', inplace=True)
+
+        # the stores written before the dataframe was kept from the oldest to the newest scrobble are turned around
+        if not df.index.is_monotonic_increasing:
+            df = df.iloc[::-1] if df.index.is_monotonic_decreasing else df.sort_index(kind='stable')
+
+        return df, int(meta['last_uts'])
+
+
+    def save(self, df: pd.DataFrame, last_uts: int) -> None:
+        """
+        Saves the user's store, replacing the previous one.
+
+        Parameters:
+            df: The dataframe with all scrobbles of the user.
+            last_uts: The Unix Timestamp of the newest scrobble in df.
+
+        Returns:
+            None.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        table = self.__table(df, {'user': self.user, 'last_uts': last_uts, 'scrobbles': len(df)})
+
+        # writing to a temporary file first so an interrupted save never leaves a half-written store behind
+        # the file is not compressed so it can be memory-mapped when loaded
+        feather.write_feather(table, self.__path + '.tmp', compression='uncompressed')
+        os.replace(self.__path + '.tmp', self.__path)
+
+
+    def schema(self) -> Optional[Tuple[pd.DataFrame, int]]:
+        """
+        Loads an empty dataframe with the same columns and categories as the stored one, without reading any scrobble.
+
+        Returns:
+            A tuple with the empty dataframe and the Unix Timestamp of the newest stored scrobble, or None if nothing was stored yet.
+        """
+        read = self.__read()
+        if read is None:
+            return None
+        table, meta = read
+
+        # a slice keeps the whole dictionaries, so the empty dataframe has all the categories
+        df = table.slice(0, 0).to_pandas()
+        df['Date'] = pd.to_datetime(df['Date'], unit='s')
+        return df.set_index('Date'), int(meta['last_uts'])
+
+
+    @staticmethod
+    def __find(seconds: pa.ChunkedArray, value: int) -> int:
+        """Finds, with a binary search within the right chunk, the first row whose Date is not before value."""
+        offset = 0
+        for array in seconds.chunks:
+            values = array.to_numpy()       # a view of the memory-mapped file, nothing is copied
+            if len(values) > 0 and values[-1] >= value:
+                return offset + int(np.searchsorted(values, value, side='left'))
+            offset += len(values)
+
+        return offset
+
+
+    def scan(self, chunk_size: int = 1_000_000, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[pd.DataFrame]:
+        """
+        Loads the user's store chunk by chunk, from the oldest to the newest scrobble. Only the chunk being converted is in memory (the file is memory-mapped).
+
+        Parameters:
+            chunk_size: The maximum number of scrobbles of each chunk. Defaults to 1,000,000.
+            start: Only the scrobbles from this local time (seconds since 1970-01-01) onwards are loaded. Defaults to None (from the first one).
+            end: Only the scrobbles before this local time (seconds since 1970-01-01) are loaded. Defaults to None (until the last one).
+
+        Returns:
+            An iterator over dataframes just like the one of load(), all of them with the same categories (and so the same codes).
+        """
+        read = self.__read()
+        if read is None:
+            return
+        table = read[0]
+
+        # the categories are converted once... the chunks only bring their codes
+        dtypes = table.slice(0, 0).to_pandas().dtypes
+
+        # the store is sorted by Date, so the rows within [start, end) are a contiguous block of it
+        first = 0 if start is None else self.__find(table.column('Date'), start)
+        last = len(table) if end is None else self.__find(table.column('Date'), end)
+
+        for offset in range(first, last, max(1, chunk_size)):
+            chunk = table.slice(offset, min(chunk_size, last - offset))
+
+            columns = {}
+            for column in ('Artist', 'Album', 'Track'):
+                codes = np.concatenate([ array.indices.to_numpy(zero_copy_only=False) for array in chunk.column(column).chunks ])
+                columns[column] = pd.Categorical.from_codes(codes, dtype=dtypes[column])
+
+            index = pd.DatetimeIndex(pd.to_datetime(chunk.column('Date').to_numpy(), unit='s'), name='Date')
+            yield pd.DataFrame(columns, index=index)
+
+
+    def append(self, df: pd.DataFrame, last_uts: int) -> None:
+        """
+        Appends newer scrobbles to the user's store. The stored scrobbles are copied batch by batch, so the store is never loaded as a whole.
+
+        Parameters:
+            df: The dataframe with the new scrobbles (all newer than the stored ones). Its categories must start with the stored ones, in the same order, so the stored codes stay valid.
+            last_uts: The Unix Timestamp of the newest scrobble in df.
+
+        Returns:
+            None.
+        """
+        read = self.__read()
+        if read is None:
+            self.save(df, last_uts)
+            return
+        stored, meta = read
+
+        table = self.__table(df, {'user': self.user, 'last_uts': last_uts, 'scrobbles': meta['scrobbles'] + len(df)})
+        dictionaries = { column: table.column(column).chunk(0).dictionary for column in ('Artist', 'Album', 'Track') }
+
+        # the stored batches keep their codes but get the new (longer) dictionaries, which may need wider codes
+        with pa.OSFile(self.__path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            for batch in stored.to_batches():
+                arrays = []
+                for field in table.schema:
+                    array = batch.column(field.name)
+                    if field.name in dictionaries:
+                        array = pa.DictionaryArray.from_arrays(array.indices.cast(field.type.index_type), dictionaries[field.name])
+                    arrays.append(array)
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=table.schema))
+
+            for batch in table.to_batches():
+                writer.write_batch(batch)
+
+        os.replace(self.__path + '.tmp', self.__path)
@@ -0,0 +1,379 @@
+from typing import Any, Dict, Iterable, Optional, Tuple
+import numpy as np
+import pandas as pd # type: ignore
+from RollupFM import RollupFM
+
+class TrendsFM:
+    """
+    Long-range trends of the whole scrobble timeline, computed with a few grouped passes over the daily rollup (and an hourly histogram of each day):
+        Rolling counts of the scrobbles and of the distinct Artists, Albums and Tracks of the last N days, for every day.
+        Streaks: the longest run of consecutive days each Artist, Album or Track was scrobbled.
+        Discoveries: the day each Artist, Album or Track was scrobbled for the first time.
+        Heatmaps of the scrobbles by day of the week and hour of the day.
+        Year-over-year deltas of any calendar period (e.g. August 2021 vs. August 2020).
+
+    Public instance variables:
+        first_day: The day of the first scrobble (None if there is none).
+        last_day: The day of the last scrobble (None if there is none).
+
+    Public methods:
+        rolling(): Counts the scrobbles and the distinct keys of the last N days, for each day.
+        streaks(): Finds the longest streak of each key.
+        discoveries(): Finds the keys scrobbled for the first time within a range of days.
+        heatmap(): Counts the scrobbles of each day of the week and hour of the day.
+        year_over_year(): Compares each year/month/week/day with the same one of the previous year.
+        year_in_review(): Puts together the trends of a year.
+    """
+    COLUMNS = {'Artist': ['Artist'], 'Album': ['Album', 'Artist'], 'Track': ['Track', 'Album', 'Artist']}
+    WEEKDAYS = 'Mon Tue Wed Thu Fri Sat Sun'.split()
+
+    def __init__(self, rollup: RollupFM, categories: Dict[str, pd.Index], epochs: Iterable[np.ndarray]) -> None:
+        """
+        Constructs the trends of the scrobbles of the rollup.
+
+        Parameters:
+            rollup: The daily rollup of the scrobbles.
+            categories: The categories (names) of the Artist, Album and Track codes, as in AnalyzerFM.df.
+            epochs: The local time (seconds since 1970-01-01) of every scrobble, in one or more arrays (e.g. one per chunk of the store).
+
+        Returns:
+            None.
+        """
+        self.__rollup = rollup
+        self.__categories = categories
+
+        # the days are counted from the first one of the rollup (every scrobble is in the Artist table)
+        days = rollup.table('Artist')['Day']
+        self.__first_day = int(days[0]) if len(days) > 0 else 0
+        self.__days = int(days[-1]) - self.__first_day + 1 if len(days) > 0 else 0
+        self.first_day = pd.Timestamp(self.__first_day, unit='D') if len(days) > 0 else None
+        self.last_day = pd.Timestamp(self.__first_day + self.__days - 1, unit='D') if len(days) > 0 else None
+
+        # the scrobbles of each day, accumulated so any range is a subtraction
+        self.__daily = np.bincount(days - self.__first_day, weights=rollup.table('Artist')['Count'], minlength=self.__days).astype(np.int64)
+        self.__cumulative = np.concatenate([[0], np.cumsum(self.__daily)])
+
+        # the scrobbles of each hour of each day
+        hourly = np.zeros(self.__days * 24, dtype=np.int64)
+        for seconds in epochs:
+            hours = seconds // 3600 - self.__first_day * 24
+            hourly += np.bincount(hours[(hours >= 0) & (hours < self.__days * 24)], minlength=self.__days * 24)
+        self.__hourly = hourly.reshape(self.__days, 24)
+
+        # the key of each bucket and, for each distinct key, its first bucket (the buckets are sorted by day, so it is also its discovery)
+        self.__labels: Dict[str, np.ndarray] = {}
+        self.__firsts: Dict[str, np.ndarray] = {}
+        self.__next_days: Dict[str, np.ndarray] = {}
+        for category in ('Artist', 'Album', 'Track'):
+            table = rollup.table(category)
+            keys = table['Artist'].astype(np.int64) if category == 'Artist' else table['Artist'].astype(np.int64) | (table[category].astype(np.int64) << 32)
+            self.__labels[category] = pd.factorize(keys)[0]
+            self.__firsts[category] = RollupFM.tally(keys)[0]
+
+
+    def __range(self, start: Optional[str], end: Optional[str]) -> Tuple[int, int]:
+        """Converts the dates [start, end) ('YYYY-MM-DD', None for the first/last scrobble) to positions of the days of the history, clipped to it."""
+        start_day = int(RollupFM.days_of(pd.DatetimeIndex([start]))[0]) - self.__first_day if start is not None else 0
+        end_day = int(RollupFM.days_of(pd.DatetimeIndex([end]))[0]) - self.__first_day if end is not None else self.__days
+        return min(max(0, start_day), self.__days), min(max(0, end_day), self.__days)
+
+
+    def __buckets(self, category: str, start: Optional[str], end: Optional[str]) -> Tuple[int, int]:
+        """Finds, with a binary search, the positions [first, last) of the category's buckets within the dates [start, end)."""
+        first, last = self.__range(start, end)
+        buckets = np.searchsorted(self.__rollup.table(category)['Day'], [self.__first_day + first, self.__first_day + last], side='left')
+        return int(buckets[0]), int(buckets[1])
+
+
+    def __decode(self, category: str, codes: Dict[str, np.ndarray], rows: np.ndarray) -> pd.DataFrame:
+        """Returns a dataframe with the names of the category's columns of the given rows."""
+        return pd.DataFrame({ column: self.__categories[column].take(codes[column][rows]) for column in self.COLUMNS[category] })
+
+
+    def __newest(self, category: str, positions: np.ndarray) -> Dict[str, np.ndarray]:
+        """Returns the codes of the given buckets, the Track ones with the album of the newest bucket of their key."""
+        table = self.__rollup.table(category)
+        codes = { column: table[column][positions] for column in self.COLUMNS[category] }
+
+        if category == 'Track':
+            # the last bucket of each key is its newest one
+            labels = self.__labels[category]
+            newest = np.zeros(labels.max() + 1 if len(labels) > 0 else 0, dtype=np.int64)
+            np.maximum.at(newest, labels, np.arange(len(labels)))
+            codes['Album'] = table['Album'][newest[labels[positions]]]
+
+        return codes
+
+
+    @staticmethod
+    def __validate_category(category: str) -> None:
+        """Verifies if the category string is valid, if not a ValueError is raised."""
+        if category not in ('Artist', 'Album', 'Track'):
+            raise ValueError(f"category should be: 'Artist', 'Album' or 'Track', but '{category}' was passed.")
+
+
+    def __next_day(self, category: str) -> np.ndarray:
+        """Returns, for each bucket of the category, the day (from the first one) of the next bucket of the same key (or the day after the history if there is none). Computed once."""
+        if category not in self.__next_days:
+            labels = self.__labels[category]
+            day = self.__rollup.table(category)['Day'] - self.__first_day
+
+            # the buckets are sorted by day, so a stable sort by key keeps the days of each key in order
+            order = np.argsort(labels, kind='stable')
+            next_day = np.full(len(order), self.__days, dtype=np.int64)
+            same_key = labels[order][1:] == labels[order][:-1]
+            next_day[order[:-1][same_key]] = day[order][1:][same_key]
+            self.__next_days[category] = next_day
+
+        return self.__next_days[category]
+
+
+    def __distinct_rolling(self, category: str, days: int, first: int, last: int) -> np.ndarray:
+        """Counts, for each day within the positions [first, last), the distinct keys of the category scrobbled within the last 'days' days (that day included)."""
+        # only the buckets of the range and of the 'days' days before it can be within its windows
+        table = self.__rollup.table(category)
+        start, end = np.searchsorted(table['Day'], [self.__first_day + first - days + 1, self.__first_day + last], side='left')
+        day = table['Day'][start:end] - self.__first_day
+
+        # a bucket keeps its key within the windows of the next 'days' days, up until the next bucket of the same key (so the coverages never overlap)
+        since = np.maximum(day, first)
+        until = np.minimum(np.minimum(day + days, self.__next_day(category)[start:end]), last)
+        covered = until > since
+
+        # +1 on the first day covered and -1 on the day right after the coverage, accumulated over the days
+        changes = np.bincount(since[covered] - first, minlength=last - first + 1) - np.bincount(until[covered] - first, minlength=last - first + 1)
+        return np.cumsum(changes)[:last - first]
+
+
+    def rolling(self, days: int = 30, start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Counts the scrobbles and the distinct Artists, Albums and Tracks of the last N days, for each day within [start, end).
+
+        Parameters:
+            days: How many days each window has (the day itself and the days before it). Defaults to 30.
+            start: String ('YYYY-MM-DD') of the first day (closed interval). Defaults to None (the first scrobble).
+            end: String ('YYYY-MM-DD') of the day after the last one (opened interval). Defaults to None (the last scrobble).
+
+        Returns:
+            A dataframe indexed by day (even the days without scrobbles) with the columns:
+                Scrobbles (of that day), Rolling Scrobbles, Rolling Artists, Rolling Albums and Rolling Tracks (of the last N days).
+        """
+        days = max(1, days)
+        first, last = self.__range(start, end)
+        positions = np.arange(first, last)
+
+        rolling = pd.DataFrame(index=pd.DatetimeIndex((self.__first_day + positions).astype('datetime64[D]'), name='Date'))
+        rolling['Scrobbles'] = self.__daily[positions]
+        rolling['Rolling Scrobbles'] = self.__cumulative[positions + 1] - self.__cumulative[np.maximum(0, positions + 1 - days)]
+        for category in ('Artist', 'Album', 'Track'):
+            rolling[f'Rolling {category}s'] = self.__distinct_rolling(category, days, first, last)
+
+        return rolling
+
+
+    def streaks(self, category: str = 'Artist', n: Optional[int] = None, start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Finds the longest streak (run of consecutive days it was scrobbled) of each key of the category within [start, end).
+
+        Parameters:
+            category: Can either be 'Artist', 'Album', or 'Track'.
+            n: How many of the longest streaks to return. Defaults to None (one for every key).
+            start: String ('YYYY-MM-DD') of the first day (closed interval). Defaults to None (the first scrobble).
+            end: String ('YYYY-MM-DD') of the day after the last one (opened interval). Defaults to None (the last scrobble).
+
+        Returns:
+            A dataframe with the columns of the category, Days (the length of the streak), Start and End (its first and last day) and Count (its scrobbles),
+            sorted from the longest streak (ties go to the most scrobbled and then to the earliest one).
+        """
+        self.__validate_category(category)
+        table = self.__rollup.table(category)
+        first, last = self.__buckets(category, start, end)
+
+        # sorting the buckets of the range by key and day... a streak starts where the key changes or a day is skipped
+        labels, day, count = self.__labels[category][first:last], table['Day'][first:last], table['Count'][first:last]
+        order = np.lexsort([day, labels])
+        labels, day, count = labels[order], day[order], count[order]
+        starts = np.concatenate([[True], (labels[1:] != labels[:-1]) | (day[1:] != day[:-1] + 1)]) if len(order) > 0 else np.array([], dtype=bool)
+
+        run = np.cumsum(starts) - 1
+        run_start = np.flatnonzero(starts)
+        run_days = np.bincount(run, minlength=len(run_start))
+        run_count = np.bincount(run, weights=count, minlength=len(run_start)).astype(np.int64)
+        run_labels = labels[run_start]
+
+        # the longest run of each key (ties go to the most scrobbled and then to the earliest one)
+        best = np.lexsort([day[run_start], -run_count, -run_days, run_labels])
+        best = best[ np.concatenate([[True], run_labels[best][1:] != run_labels[best][:-1]]) ] if len(best) > 0 else best
+
+        # sorting the keys by their longest streak
+        best = best[ np.lexsort([day[run_start][best], -run_count[best], -run_days[best]]) ]
+        if n is not None:
+            best = best[:max(0, n)]
+
+        streaks = self.__decode(category, self.__newest(category, first + order[run_start[best]]), np.arange(len(best)))
+        streaks['Days'] = run_days[best]
+        streaks['Start'] = pd.DatetimeIndex(day[run_start[best]].astype('datetime64[D]'))
+        streaks['End'] = streaks['Start'] + pd.to_timedelta(run_days[best] - 1, unit='D')
+        streaks['Count'] = run_count[best]
+        return streaks
+
+
+    def discoveries(self, category: str = 'Artist', start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Finds the keys of the category scrobbled for the first time (in the whole history) within [start, end).
+
+        Parameters:
+            category: Can either be 'Artist', 'Album', or 'Track'.
+            start: String ('YYYY-MM-DD') of the first day (closed interval). Defaults to None (the first scrobble).
+            end: String ('YYYY-MM-DD') of the day after the last one (opened interval). Defaults to None (the last scrobble).
+
+        Returns:
+            A dataframe with the columns of the category, Discovered (the day of the first scrobble) and Count (the scrobbles within [start, end)),
+            sorted from the most scrobbled (ties go to the earliest discovery).
+        """
+        self.__validate_category(category)
+        table = self.__rollup.table(category)
+        first, last = self.__buckets(category, start, end)
+
+        # the discoveries of the range are the first buckets within it... and their scrobbles are counted over the buckets of the range
+        firsts = self.__firsts[category]
+        discovered = firsts[(firsts >= first) & (firsts < last)]
+        counts = np.bincount(self.__labels[category][first:last], weights=table['Count'][first:last], minlength=len(firsts)).astype(np.int64)
+        counts = counts[self.__labels[category][discovered]]
+
+        order = np.lexsort([discovered, -counts])
+        discoveries = self.__decode(category, self.__newest(category, discovered[order]), np.arange(len(order)))
+        discoveries['Discovered'] = pd.DatetimeIndex(table['Day'][discovered[order]].astype('datetime64[D]'))
+        discoveries['Count'] = counts[order]
+        return discoveries
+
+
+    def heatmap(self, start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Counts the scrobbles of each day of the week and hour of the day (local time) within [start, end).
+
+        Parameters:
+            start: String ('YYYY-MM-DD') of the first day (closed interval). Defaults to None (the first scrobble).
+            end: String ('YYYY-MM-DD') of the day after the last one (opened interval). Defaults to None (the last scrobble).
+
+        Returns:
+            A dataframe with one row per day of the week (Mon to Sun) and one column per hour (0 to 23).
+        """
+        first, last = self.__range(start, end)
+
+        # 1970-01-01 was a Thursday
+        weekdays = (self.__first_day + np.arange(first, last) + 3) % 7
+        heatmap = np.zeros((7, 24), dtype=np.int64)
+        np.add.at(heatmap, weekdays, self.__hourly[first:last])
+
+        return pd.DataFrame(heatmap, index=pd.Index(self.WEEKDAYS, name='Weekday'), columns=pd.RangeIndex(24, name='Hour'))
+
+
+    def __totals(self, periods: pd.PeriodIndex) -> pd.DataFrame:
+        """Counts the scrobbles and the distinct Artists, Albums and Tracks of each of the given periods (of the same frequency), with one grouped pass per category."""
+        ordinals = periods.asi8
+        base, size = int(ordinals.min()), int(ordinals.max() - ordinals.min() + 1)
+        start_day, end_day = RollupFM.days_of(pd.DatetimeIndex([periods.start_time.min(), periods.end_time.max().normalize() + pd.Timedelta(1, 'D')]))
+
+        # the ordinals of the years, months and days are plain numpy conversions (the ones of the weeks need pandas)
+        unit = periods.freqstr[0] if periods.freqstr[0] in ('Y', 'M', 'D') else None
+
+        def groups(days: np.ndarray) -> np.ndarray:
+            if unit is not None:
+                return days.astype('datetime64[D]').astype(f'datetime64[{unit}]').astype(np.int64) - base
+            return pd.DatetimeIndex(days.astype('datetime64[D]')).to_period(periods.freq).asi8 - base
+
+        totals = {}
+        for category in ('Artist', 'Album', 'Track'):
+            codes, counts = self.__rollup.count(int(start_day), int(end_day), category, groups=groups)
+            totals[f'{category.lower()}s'] = np.bincount(codes['Group'], minlength=size)
+            if category == 'Artist':
+                totals['scrobbles'] = np.bincount(codes['Group'], weights=counts, minlength=size).astype(np.int64)
+
+        return pd.DataFrame({ name: values[ordinals - base] for name, values in totals.items() })[['scrobbles', 'artists', 'albums', 'tracks']]
+
+
+    def year_over_year(self, freq: str = 'M', start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        """
+        Compares the scrobbles and the distinct Artists, Albums and Tracks of each year/month/week/day within [start, end) with the same period of the previous year.
+        The previous period is calendar-correct (e.g. the same month, or the week of the same date, one year earlier).
+
+        Parameters:
+            freq: Can either be 'Y' (years), 'M' (months), 'W' (weeks, from Monday to Sunday), or 'D' (days).
+            start: String ('YYYY-MM-DD') of the first day (closed interval). Defaults to None (the first scrobble).
+            end: String ('YYYY-MM-DD') of the day after the last one (opened interval), which should be after start. Defaults to None (the last scrobble).
+
+        Returns:
+            A dataframe with one row per period (even the ones without scrobbles) and the columns:
+                period, previous_period, and for each of scrobbles, artists, albums and tracks: its value, its previous_ value and its _delta (in %, as in AnalyzerFM.summary_highlights()).
+        """
+        if freq not in ('Y', 'M', 'W', 'D'):
+            raise ValueError(f"freq should be: 'Y', 'M', 'W' or 'D', but '{freq}' was passed.")
+
+        columns = ['scrobbles', 'artists', 'albums', 'tracks']
+        start_date = pd.Timestamp(start) if start is not None else self.first_day
+        end_date = pd.Timestamp(end) if end is not None else self.last_day + pd.Timedelta(1, 'D') if self.last_day is not None else None
+        if start_date is None or end_date is None:     # without scrobbles, there is no first or last one to default to
+            return pd.DataFrame(columns=['period', 'previous_period'] + [ name for column in columns for name in (column, f'previous_{column}', f'{column}_delta') ])
+
+        pandas_freq = {'Y': 'Y', 'M': 'M', 'W': 'W-SUN', 'D': 'D'}[freq]
+        if end_date <= start_date:
+            raise ValueError(f"end should be after start, but '{start_date.strftime('%Y-%m-%d')}' and '{end_date.strftime('%Y-%m-%d')}' were passed.")
+
+        periods = pd.period_range(start_date, end_date - pd.Timedelta(1, 'D'), freq=pandas_freq)
+        previous = (periods.start_time - pd.DateOffset(years=1)).to_period(pandas_freq)
+
+        current_totals, previous_totals = self.__totals(periods), self.__totals(previous)
+        comparison = pd.DataFrame({'period': periods.astype(str), 'previous_period': previous.astype(str)})
+        for column in columns:
+            current_values, previous_values = current_totals[column].to_numpy(), previous_totals[column].to_numpy()
+            comparison[column] = current_values
+            comparison[f'previous_{column}'] = previous_values
+
+            # no scrobbles during both periods is 0%, otherwise the previous period counts as at least 1 (avoiding division by zero)
+            delta = np.round( (current_values / np.maximum(1, previous_values) - 1) * 100 ).astype(np.int64)
+            comparison[f'{column}_delta'] = np.where((current_values != 0) | (previous_values != 0), delta, 0)
+
+        return comparison
+
+
+    def year_in_review(self, year: str, n: int = 5, days: int = 30) -> Dict[str, Any]:
+        """
+        Puts together the trends of a year.
+
+        Parameters:
+            year: the desired year in 'YYYY' format.
+            n: How many discoveries and streaks of each category are listed. Defaults to 5.
+            days: How many days the rolling window has. Defaults to 30.
+
+        Returns:
+            A dict with:
+                totals: The year compared with the previous one (a row of year_over_year()).
+                months: Each month compared with the same month of the previous year.
+                discoveries: The number of Artists, Albums and Tracks scrobbled for the first time that year.
+                top_discoveries: The n most scrobbled discoveries of each category.
+                streaks: The n longest streaks of each category.
+                busiest_day: The day with the most scrobbles and how many it had.
+                busiest_window: The last day of the busiest N days and how many scrobbles they had.
+                heatmap: The scrobbles by day of the week and hour.
+        """
+        start, end = f'{year}-01-01', f'{int(year) + 1}-01-01'
+        rolling = self.rolling(days, start, end)
+        discoveries = { category: self.discoveries(category, start, end) for category in ('Artist', 'Album', 'Track') }
+
+        review: Dict[str, Any] = {
+            'totals': self.year_over_year('Y', start, end).iloc[0].to_dict(),
+            'months': self.year_over_year('M', start, end),
+            'discoveries': { category: len(discovered) for category, discovered in discoveries.items() },
+            'top_discoveries': { category: discovered.head(n) for category, discovered in discoveries.items() },
+            'streaks': { category: self.streaks(category, n, start, end) for category in ('Artist', 'Album', 'Track') },
+            'busiest_day': None,
+            'busiest_window': None,
+            'heatmap': self.heatmap(start, end)
+        }
+
+        if not rolling.empty:
+            review['busiest_day'] = (rolling['Scrobbles'].idxmax(), int(rolling['Scrobbles'].max()))
+            review['busiest_window'] = (rolling['Rolling Scrobbles'].idxmax(), int(rolling['Rolling Scrobbles'].max()))
+
+        return review
@@ -0,0 +1,50 @@
+"""
+Benchmarks the AnalyzerFM ingestion against the local stub server, fetching the pages sequentially and concurrently.
+
+Usage (from the repository root):
+    python benchmarks/bench_fetch.py [scrobbles] [latency]
+"""
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_server import StubServer, generate_scrobbles
+from LastFM import LastFM
+from AnalyzerFM import AnalyzerFM
+
+
+def time_ingestion(url: str, max_workers: int) -> float:
+    """Builds an AnalyzerFM from an empty working directory (i.e. a cold cache) and returns how long it took."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            with open('.env', 'w') as env:
+                env.write('API_KEY=benchmark\n')
+
+            start = perf_counter()
+            AnalyzerFM('benchmark', max_workers=max_workers, api=LastFM(api_root=url, requests_per_second=1000))
+            return perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    server = StubServer(generate_scrobbles(total), latency=latency)
+    server.start()
+
+    try:
+        results = {workers: time_ingestion(server.url, workers) for workers in (1, 4, 8, 16)}
+    finally:
+        server.stop()
+
+    print(f'\n--Ingestion of {total} scrobbles ({-(-total // 200)} pages, {latency * 1000:.0f} ms latency)--')
+    for workers, seconds in results.items():
+        print(f'max_workers={workers:<3} {seconds:7.2f} s   speedup: {results[1] / seconds:.1f}x')
@@ -0,0 +1,250 @@
+"""
+Benchmarks every stage of the analyzer on synthetic histories (see fixtures.ZipfHistory) served by the local stub server:
+    generate: generating the synthetic history (not part of the analyzer, just for reference).
+    ingestion: fetching every page from the stub server, building the dataframe and storing it (AnalyzerFM from an empty directory).
+    build: building the dataframe from pages already in memory (BuilderFM).
+    load: loading the stored dataframe and indexing it (AnalyzerFM offline).
+    top_by, highlights_of, summary_highlights: the queries over every year/month of the history, without the cache.
+    chart_*: each PlotterFM chart of the last full year of the history, rendered headless (and saved in a temporary directory).
+    charts_render_year: all the charts of that year at once (PlotterFM.render_year()).
+
+Each stage reports its best time (of --repeat runs), its throughput (scrobbles per second, or milliseconds per call) and its peak memory (traced by tracemalloc in a second run).
+The results are saved as json, so they can be compared between versions (--compare).
+
+Usage (from the repository root):
+    python benchmarks/bench_suite.py [--sizes 10000,100000,1000000] [--latency 0] [--max-workers 8] [--repeat 3] [--output results.json] [--compare old.json] [--no-memory]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas as pd # type: ignore
+from fixtures import ZipfHistory
+from stub_server import StubServer
+from AnalyzerFM import AnalyzerFM
+from BuilderFM import BuilderFM
+from LastFM import LastFM
+from PlotterFM import PlotterFM
+from StoreFM import StoreFM
+
+class WorkDir:
+    """A temporary working directory (with the .env the LastFM client needs) that is entered and left with a with statement."""
+    def __enter__(self) -> str:
+        self.__cwd = os.getcwd()
+        self.__workdir = tempfile.TemporaryDirectory()
+        os.chdir(self.__workdir.name)
+        with open('.env', 'w') as env:
+            env.write('API_KEY=benchmark\n')
+        return self.__workdir.name
+
+    def __exit__(self, *args: Any) -> None:
+        os.chdir(self.__cwd)
+        self.__workdir.cleanup()
+
+
+def measure(step: Callable[[], int], scrobbles: int, memory: bool, repeat: int = 1) -> Dict[str, Any]:
+    """Runs the step (which returns how many calls it made, 0 for a single one) and returns its best time, throughput and, if asked, its peak memory (from another run)."""
+    # the best of the runs is the least disturbed by the rest of the machine
+    seconds = float('inf')
+    for _ in range(max(1, repeat)):
+        gc.collect()
+        start = perf_counter()
+        calls = step()
+        seconds = min(seconds, perf_counter() - start)
+
+    result: Dict[str, Any] = {'seconds': round(seconds, 6)}
+    if calls > 0:
+        result['calls'] = calls
+        result['ms_per_call'] = round(seconds / calls * 1000, 4)
+    else:
+        result['scrobbles_per_second'] = round(scrobbles / seconds) if seconds > 0 else None
+
+    # tracemalloc slows the step down, so the memory is traced in a run that is not timed
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        step()
+        result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+
+    return result
+
+
+def benchmark(total: int, latency: float, max_workers: int, memory: bool, repeat: int) -> Dict[str, Dict[str, Any]]:
+    """Runs every stage for a synthetic history of 'total' scrobbles."""
+    results: Dict[str, Dict[str, Any]] = {}
+
+    # the history ends two days ago, so every scrobble is within the windows fetched by the analyzer
+    end_uts = (int(datetime.now().timestamp()) // 86400 - 2) * 86400
+    def generate() -> int:
+        ZipfHistory(total, end_uts=end_uts)
+        return 0
+
+    results['generate'] = measure(generate, total, memory=False, repeat=repeat)
+    history = ZipfHistory(total, end_uts=end_uts)
+
+    server = StubServer(history, latency=latency)
+    server.start()
+
+    with WorkDir():
+        def ingest() -> int:
+            # the progress of each page is printed, which is not part of the report
+            with WorkDir(), contextlib.redirect_stdout(io.StringIO()):
+                AnalyzerFM('benchmark', max_workers=max_workers, api=LastFM(api_root=server.url, requests_per_second=10**6, cache_name=None))
+            return 0
+
+        results['ingestion'] = measure(ingest, total, memory, repeat)
+        server.stop()
+
+        def build() -> int:
+            builder = BuilderFM()
+            for page in history.pages():
+                builder.add_page(page)
+            builder.to_df(0)
+            return 0
+
+        results['build'] = measure(build, total, memory, repeat)
+
+        # a store to be loaded by the remaining stages
+        builder = BuilderFM()
+        for page in history.pages():
+            builder.add_page(page)
+        StoreFM('benchmark').save(builder.to_df(LastFM(cache_name=None).timezone_offset), builder.last_uts)
+        del builder
+
+        def load() -> int:
+            AnalyzerFM('benchmark', cache_size=0, offline=True)
+            return 0
+
+        results['load'] = measure(load, total, memory, repeat)
+        analyzer = AnalyzerFM('benchmark', cache_size=0, offline=True)
+
+        # the queries run over every year and month of the history (the last ones at most), without the cache
+        years = [ str(year) for year in range(analyzer.first_day.year, analyzer.last_day.year + 1) ][-5:]
+        months = [ str(month) for month in pd.period_range(analyzer.first_day, analyzer.last_day, freq='M') ][-24:]
+
+        def top_by() -> int:
+            for year in years:
+                for category in ('Artist', 'Album', 'Track'):
+                    analyzer.top_by('year', year, category, n=10)
+            return len(years) * 3
+
+        def highlights_of() -> int:
+            for month in months:
+                analyzer.highlights_of('month', month)
+            return len(months)
+
+        def summary_highlights() -> int:
+            for month in months[-12:]:
+                analyzer.summary_highlights('month', month)
+            return len(months[-12:])
+
+        results['top_by'] = measure(top_by, total, memory, repeat)
+        results['highlights_of'] = measure(highlights_of, total, memory, repeat)
+        results['summary_highlights'] = measure(summary_highlights, total, memory, repeat)
+
+        # each chart gets a new (headless) plotter, so its time includes computing the monthly highlights it needs
+        chart_year = str(analyzer.last_day.year - 1) if analyzer.first_day.year < analyzer.last_day.year else str(analyzer.last_day.year)
+        for chart in PlotterFM.CHARTS:
+            def render(chart: str = chart) -> int:
+                getattr(PlotterFM('benchmark', analyzer=analyzer, headless=True), chart)(chart_year)
+                return 1
+
+            results[f'chart_{chart}'] = measure(render, total, memory, repeat)
+
+        # all the charts of the year from the same monthly highlights, as the batch rendering does
+        def render_year() -> int:
+            PlotterFM('benchmark', analyzer=analyzer, headless=True).render_year(chart_year)
+            return len(PlotterFM.CHARTS)
+
+        results['charts_render_year'] = measure(render_year, total, memory, repeat)
+
+    return results
+
+
+def git_version() -> Optional[str]:
+    """Returns the current commit of the repository (with a + if it has uncommitted changes), or None if it is not available."""
+    try:
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('+' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any], threshold: float) -> List[str]:
+    """Prints the time ratio of each stage against a previous report and returns the stages that got slower than the threshold."""
+    regressions = []
+    print(f"\n--Compared to {previous.get('version')} ({previous.get('date')})--")
+    for size, steps in current['results'].items():
+        for step, result in steps.items():
+            old = previous.get('results', {}).get(size, {}).get(step)
+            if old is None or not old.get('seconds'):
+                continue
+
+            ratio = result['seconds'] / old['seconds']
+            flag = '  <-- slower' if ratio > threshold else ''
+            print(f'{size:>9} {step:<30} {old["seconds"]:9.3f} s -> {result["seconds"]:9.3f} s  ({ratio:.2f}x){flag}')
+            if flag:
+                regressions.append(f'{size}/{step}')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the analyzer on synthetic Last.fm histories.')
+    parser.add_argument('--sizes', default='10000,100000', help='comma separated history sizes (e.g. 10000,100000,1000000,5000000)')
+    parser.add_argument('--latency', type=float, default=0.0, help='artificial latency of each stub request, in seconds')
+    parser.add_argument('--max-workers', type=int, default=8, help='how many pages are fetched concurrently')
+    parser.add_argument('--output', default=None, help='where the json report is saved (defaults to benchmarks/results/<version>.json)')
+    parser.add_argument('--compare', default=None, help='a previous json report to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='how much slower (ratio) a stage can get before it is flagged')
+    parser.add_argument('--repeat', type=int, default=3, help='how many times each stage runs (its best time is reported)')
+    parser.add_argument('--no-memory', action='store_true', help='skips the second (traced) run of each stage')
+    args = parser.parse_args()
+
+    report: Dict[str, Any] = {
+        'version': git_version(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'latency': args.latency, 'max_workers': args.max_workers, 'repeat': args.repeat},
+        'results': {}
+    }
+
+    for size in [ int(size) for size in args.sizes.split(',') ]:
+        print(f'\n--{size} scrobbles--')
+        report['results'][str(size)] = benchmark(size, args.latency, args.max_workers, not args.no_memory, args.repeat)
+        for step, result in report['results'][str(size)].items():
+            throughput = f"{result['ms_per_call']:9.2f} ms/call" if 'ms_per_call' in result else f"{result['scrobbles_per_second'] or 0:9d} scrobbles/s"
+            memory = f"{result['peak_mb']:9.1f} MB peak" if 'peak_mb' in result else ''
+            print(f'{step:<30} {result["seconds"]:9.3f} s {throughput} {memory}')
+
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f"{report['version'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f'\nmax RSS {report["max_rss_mb"]} MB, report saved to {output}')
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            regressions = compare(report, json.load(previous_file), args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,96 @@
+"""
+Synthetic Last.fm histories used by the benchmarks.
+
+The scrobbles are kept as columns of codes (and not as json dicts), so histories of millions of scrobbles fit in memory.
+Only the scrobbles of a requested page are turned into the json dicts the Last.fm API returns.
+"""
+from time import gmtime, strftime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+
+class ZipfHistory:
+    """
+    A synthetic history with Zipf-distributed artists, albums and tracks (a few of them are scrobbled a lot, most of them only a few times).
+
+    Public instance variables:
+        total: How many scrobbles the history has.
+        uts: The Unix Timestamp of each scrobble, the newest first (as the API returns them).
+
+    Public methods:
+        window(): Finds the scrobbles within [from_uts, to_uts].
+        scrobbles(): Builds the json dicts of a block of scrobbles.
+        pages(): Builds the json of every user.getrecenttracks page of the history.
+    """
+    ALBUMS_PER_ARTIST = 5
+    TRACKS_PER_ALBUM = 12
+
+    def __init__(self, total: int, exponent: float = 1.1, artists: int = 0, start_uts: int = 1514764800, end_uts: Optional[int] = None, seed: int = 0) -> None:
+        """
+        Generates the history.
+
+        Parameters:
+            total: How many scrobbles the history has (e.g. from 10,000 to 5,000,000).
+            exponent: The exponent of the Zipf distributions. Defaults to 1.1.
+            artists: How many distinct artists there are. Defaults to 0 (one for every 50 scrobbles, at least 10).
+            start_uts: The Unix Timestamp the history starts from. Defaults to 2018-01-01.
+            end_uts: The Unix Timestamp of the newest scrobble, which overrides start_uts (e.g. so a large history does not go past today). Defaults to None.
+            seed: The seed of the random generator, so the same arguments always generate the same history. Defaults to 0.
+
+        Returns:
+            None.
+        """
+        rng = np.random.default_rng(seed)
+        artists = artists if artists > 0 else max(10, total // 50)
+        self.total = total
+
+        def zipf(size: int) -> np.ndarray:
+            weights = 1 / np.arange(1, size + 1) ** exponent
+            return rng.choice(size, size=total, p=weights / weights.sum()).astype(np.int32)
+
+        # generated from the oldest to the newest scrobble (one every 1 to 10 minutes) and kept the newest first
+        self.__artist = zipf(artists)[::-1]
+        self.__album = zipf(self.ALBUMS_PER_ARTIST)[::-1]
+        self.__track = zipf(self.TRACKS_PER_ALBUM)[::-1]
+        self.__web_player = (rng.random(total) < 0.02)[::-1]     # a few songs listened in the Last.fm Web Player (without album)
+        uts = np.cumsum(rng.integers(60, 600, size=total))
+        self.uts = (uts + (start_uts if end_uts is None or total == 0 else end_uts - int(uts[-1])))[::-1]
+        self.__negated_uts = -self.uts      # ascending, so the windows can be found with a binary search
+
+
+    def __len__(self) -> int:
+        """Returns how many scrobbles the history has."""
+        return self.total
+
+
+    def window(self, from_uts: int, to_uts: int) -> Tuple[int, int]:
+        """Returns the positions [first, last) of the scrobbles within [from_uts, to_uts] (the newest first)."""
+        first = np.searchsorted(self.__negated_uts, -to_uts, side='left')
+        last = np.searchsorted(self.__negated_uts, -from_uts, side='right')
+        return int(first), int(last)
+
+
+    def scrobbles(self, first: int, last: int) -> List[Dict[str, Any]]:
+        """Builds the json dicts of the scrobbles at the positions [first, last), just like the Last.fm API returns them."""
+        tracks = []
+        for artist, album, track, web_player, uts in zip(self.__artist[first:last], self.__album[first:last], self.__track[first:last],
+                                                        self.__web_player[first:last], self.uts[first:last]):
+            album_name = f'Artist {artist} - Album {album}'
+            tracks.append({
+                'artist': {'mbid': '', '#text': f'Artist {artist}'},
+                'album': {'mbid': '', '#text': '' if web_player else album_name},
+                'name': f'{album_name} - Track {track}',
+                'date': {'uts': str(uts), '#text': strftime('%d %b %Y, %H:%M', gmtime(int(uts)))}
+            })
+
+        return tracks
+
+
+    def pages(self, limit: int = 200) -> Iterator[Dict[str, Any]]:
+        """Builds, one at a time, the json of every user.getrecenttracks page of the whole history."""
+        total_pages = -(-self.total // limit)
+        for page in range(total_pages):
+            yield {'recenttracks': {
+                'track': self.scrobbles(page * limit, min(self.total, (page + 1) * limit)),
+                '@attr': {'page': str(page + 1), 'perPage': str(limit), 'totalPages': str(total_pages), 'total': str(self.total)}
+            }}
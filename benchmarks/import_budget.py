@@ -0,0 +1,108 @@
+"""
+Measures the cold start of the analyzer in fresh interpreters and checks it against a budget:
+    baseline: importing pandas and pyarrow, which every run needs (not part of the budget, the other checks are measured on top of it).
+    import_LastFM, import_AnalyzerFM, import_PlotterFM: importing each module.
+    summary_highlights: importing the analyzer, loading a stored synthetic history (see fixtures.ZipfHistory) offline and answering summary_highlights() of its last month.
+
+The budgets are the seconds each check may take on top of the baseline, so they hold on slower machines as well.
+Each check also has the modules it must never import (e.g. matplotlib before a chart is rendered, or requests when offline).
+Exits with 1 if any check went over its budget or imported one of its forbidden modules.
+
+Usage (from the repository root):
+    python benchmarks/import_budget.py [--size 100000] [--repeat 5] [--budget import_AnalyzerFM=0.1 --budget summary_highlights=0.5]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# each check: the code timed in a fresh interpreter (which imports the baseline too), the modules it must not import and its budget (seconds on top of the baseline)
+CHECKS: Dict[str, Tuple[str, Tuple[str, ...], float]] = {
+    'baseline': ('import pandas, pyarrow.feather', (), 0.0),
+    'import_LastFM': ('import pandas, pyarrow.feather, LastFM', ('requests', 'IPython', 'matplotlib'), 0.1),
+    'import_AnalyzerFM': ('import AnalyzerFM', ('requests', 'IPython', 'matplotlib'), 0.15),
+    'import_PlotterFM': ('import PlotterFM', ('requests', 'IPython', 'matplotlib'), 0.2),
+    'summary_highlights': ("from AnalyzerFM import AnalyzerFM\nAnalyzerFM('budget', offline=True).summary_highlights('month', MONTH)", ('requests', 'IPython', 'matplotlib'), 0.5),
+}
+
+# the timed code runs between the two perf_counter() calls, the interpreter's own startup is left out
+CHILD = """
+from time import perf_counter
+start = perf_counter()
+{code}
+seconds = perf_counter() - start
+import json, sys
+print(json.dumps({{'seconds': seconds, 'imported': [ module for module in {forbidden!r} if module in sys.modules ]}}))
+"""
+
+
+def run(code: str, forbidden: Tuple[str, ...], workdir: str) -> Dict[str, object]:
+    """Runs the code in a fresh interpreter (within workdir, with the repository in its path) and returns its seconds and the forbidden modules it imported."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join( path for path in (ROOT, os.environ.get('PYTHONPATH')) if path ))
+    output = subprocess.run([sys.executable, '-c', CHILD.format(code=code, forbidden=forbidden)], cwd=workdir, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def store_history(size: int, workdir: str) -> str:
+    """Stores a synthetic history of 'size' scrobbles as the user 'budget' within workdir and returns its last month ('YYYY-MM')."""
+    from fixtures import ZipfHistory
+    from BuilderFM import BuilderFM
+    from StoreFM import StoreFM
+
+    builder = BuilderFM()
+    for page in ZipfHistory(size).pages():
+        builder.add_page(page)
+    df = builder.to_df(0)
+    StoreFM('budget', os.path.join(workdir, 'scrobbles')).save(df, builder.last_uts)
+
+    return df.index[-1].strftime('%Y-%m')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the cold start of the analyzer against an import-time budget.')
+    parser.add_argument('--size', type=int, default=100_000, help='how many scrobbles the stored history of the summary_highlights check has')
+    parser.add_argument('--repeat', type=int, default=5, help='how many fresh interpreters run each check (its best time is reported)')
+    parser.add_argument('--budget', action='append', default=[], help='overrides the budget of a check, in seconds on top of the baseline (e.g. import_AnalyzerFM=0.1)')
+    args = parser.parse_args()
+
+    budgets = { check: budget for check, (_, _, budget) in CHECKS.items() }
+    for override in args.budget:
+        check, _, budget = override.partition('=')
+        if check not in budgets:
+            raise ValueError(f"check should be: {', '.join(repr(name) for name in CHECKS)}, but '{check}' was passed.")
+        budgets[check] = float(budget)
+
+    failures: List[str] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        month = store_history(args.size, workdir)
+
+        # the checks take turns (one round runs each of them once), so a slower moment of the machine slows all of them down alike...
+        # the first round also warms up the disk cache and the best of the runs of each check is the least disturbed one
+        runs: Dict[str, List[Dict[str, object]]] = { check: [] for check in CHECKS }
+        for _ in range(max(1, args.repeat) + 1):
+            for check, (code, forbidden, _) in CHECKS.items():
+                runs[check].append( run(code.replace('MONTH', repr(month)), forbidden, workdir) )
+
+    baseline = min( float(result['seconds']) for result in runs['baseline'][1:] )  # type: ignore
+    print(f"{'baseline':<20} {baseline:7.3f} s")
+
+    for check in CHECKS:
+        if check == 'baseline':
+            continue
+
+        seconds = min( float(result['seconds']) for result in runs[check][1:] )  # type: ignore
+        imported = sorted({ module for result in runs[check] for module in result['imported'] })  # type: ignore
+        over = seconds - baseline > budgets[check]
+        print(f'{check:<20} {seconds:7.3f} s  ({seconds - baseline:+.3f} s over the baseline, budget +{budgets[check]:.3f} s)' + ('  <-- over budget' if over else '')
+              + (f"  <-- imported {', '.join(imported)}" if imported else ''))
+        if over or imported:
+            failures.append(check)
+
+    sys.exit(1 if failures else 0)
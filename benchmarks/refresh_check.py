@@ -0,0 +1,99 @@
+"""
+Checks that the new scrobbles reach the analyzers kept warm by ServerFM, with the cache of responses enabled (as by default):
+    post_refresh: a POST /users/<user>/refresh, once the cached responses of the current month expired, returns the new scrobbles and the queries see them.
+    background_refresh: the background refresh finds the scrobbles that arrived afterwards, without any request.
+    locks: no per-user lock is left behind once the requests are answered.
+
+The history (see fixtures.ZipfHistory) is served by the local stub server, which then serves the same history with a few new scrobbles.
+Each check waits for the cached responses of the current month to expire (see LastFM's cache_ttl), as a refresh within that time gets no new scrobbles.
+Exits with 1 if any check fails.
+
+Usage (from the repository root):
+    python benchmarks/refresh_check.py [--size 30000] [--ttl 1]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import urllib.request
+from datetime import date, datetime, timedelta
+from time import gmtime, sleep, strftime
+from typing import Any, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_suite import WorkDir
+from fixtures import ZipfHistory
+from stub_server import StubServer
+from LastFM import LastFM
+from ServerFM import ServerFM
+
+
+def request(server: ServerFM, path: str, method: str = 'GET') -> Any:
+    """Sends a request to the server and returns its json."""
+    with urllib.request.urlopen(urllib.request.Request(server.url + path, method=method)) as response:
+        return json.loads(response.read())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that ServerFM refreshes its warm users with the cache of responses enabled.')
+    parser.add_argument('--size', type=int, default=30_000, help='how many scrobbles the history has')
+    parser.add_argument('--ttl', type=float, default=1.0, help='for how many seconds the responses of the live windows are cached')
+    args = parser.parse_args()
+
+    # the history ends yesterday at noon: the scrobbles are fetched up to the end of yesterday, and the responses of its month are only cached for the ttl
+    yesterday = date.today() - timedelta(days=1)
+    history = ZipfHistory(args.size, end_uts=int(datetime.combine(yesterday, datetime.min.time()).timestamp()) + 12 * 3600)
+    scrobbles = history.scrobbles(0, len(history))
+    stub = StubServer(scrobbles, latency=0.0)
+    stub.start()
+
+    def scrobble(count: int) -> None:
+        """Serves the history with 'count' new scrobbles (copies of the newest one, a minute apart)."""
+        global scrobbles
+        newest = scrobbles[0]
+        uts = [ int(newest['date']['uts']) + 60 * (count - i) for i in range(count) ]
+        scrobbles = [ dict(newest, date={'uts': str(value), '#text': strftime('%d %b %Y, %H:%M', gmtime(value))}) for value in uts ] + scrobbles
+        stub.replace(scrobbles)
+
+    failures: List[str] = []
+    with WorkDir(), contextlib.redirect_stdout(io.StringIO()):
+        api = LastFM(api_root=stub.url, requests_per_second=10**6, cache_ttl=args.ttl)
+        year = str(yesterday.year)
+
+        def total(server: ServerFM) -> int:
+            return request(server, f'/users/refresh/highlights_of?period=year&date={year}')['total_scrobbles']
+
+        # without the background refresh, so only the POST finds the new scrobbles
+        server = ServerFM(port=0, api=api, refresh_interval=0)
+        server.start()
+        before = total(server)
+        scrobble(3)
+        sleep(args.ttl * 1.2)
+        new_scrobbles = request(server, '/users/refresh/refresh', 'POST')['new_scrobbles']
+        if new_scrobbles != 3 or total(server) != before + 3:
+            failures.append(f'post_refresh: 3 new scrobbles, but the refresh returned {new_scrobbles} and the highlights have {total(server) - before} more')
+        server.stop()
+
+        # the same client (and its cache) in a server that refreshes every 2 ttl
+        server = ServerFM(port=0, api=api, refresh_interval=args.ttl * 2)
+        server.start()
+        before = total(server)
+        scrobble(2)
+        for _ in range(50):
+            sleep(args.ttl / 5)
+            if total(server) > before:
+                break
+        if total(server) != before + 2:
+            failures.append(f'background_refresh: 2 new scrobbles, but the highlights have {total(server) - before} more')
+
+        if server._ServerFM__locks:  # type: ignore
+            failures.append(f'locks: {len(server._ServerFM__locks)} left behind')  # type: ignore
+        server.stop()
+
+    stub.stop()
+    print('\n'.join(failures) if failures else 'all checks passed')
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,124 @@
+"""
+A local stub of the Last.fm API (ws.audioscrobbler.com) used by the benchmarks.
+
+It serves paginated user.getrecenttracks json, newest scrobble first, with an artificial latency per request
+so that the network-bound parts of the analyzer can be measured without touching the real servers.
+The scrobbles are either a list of json dicts (see generate_scrobbles()) or a columnar history (see fixtures.ZipfHistory).
+"""
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep, strftime, gmtime
+from typing import Any, Dict, List, Tuple, Union
+from urllib.parse import urlparse, parse_qs
+from fixtures import ZipfHistory
+
+
+def generate_scrobbles(total: int, start_uts: int = 1514764800, seed: int = 0) -> List[Dict[str, Any]]:
+    """Generates 'total' fake scrobbles (newest first) in the same format the Last.fm API returns them."""
+    rng = random.Random(seed)
+    artists = [f'Artist {i}' for i in range(max(1, total // 100))]
+
+    scrobbles = []
+    uts = start_uts
+    for _ in range(total):
+        uts += rng.randint(60, 600)     # one scrobble every 1 to 10 minutes
+        artist = rng.choice(artists)
+        album = f'{artist} - Album {rng.randint(0, 4)}'
+
+        scrobbles.append({
+            'artist': {'mbid': '', '#text': artist},
+            'album': {'mbid': '', '#text': album},
+            'name': f'{album} - Track {rng.randint(0, 11)}',
+            'date': {'uts': str(uts), '#text': strftime('%d %b %Y, %H:%M', gmtime(uts))}
+        })
+
+    return scrobbles[::-1]
+
+
+class StubServer:
+    """
+    A threaded HTTP server answering user.getrecenttracks (and user.getinfo) requests from a fixed list of scrobbles.
+
+    Public instance variables:
+        url: The API root URL location to be passed to LastFM(api_root=...).
+        requests_served: How many requests were answered so far.
+
+    Public methods:
+        start(): Starts serving in a background thread.
+        stop(): Shuts the server down.
+        replace(): Serves another list of scrobbles (e.g. the same history with new scrobbles).
+    """
+    def __init__(self, scrobbles: Union[List[Dict[str, Any]], ZipfHistory], latency: float = 0.05, port: int = 0) -> None:
+        self.requests_served = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                body, status = stub.respond(query)
+                sleep(latency)
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass    # keeping the benchmark output clean
+
+        self.__scrobbles = scrobbles
+        self.__server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = f'http://127.0.0.1:{self.__server.server_address[1]}/2.0'
+
+
+    def respond(self, query: Dict[str, str]) -> Tuple[bytes, int]:
+        """Builds the json body and the status code for the given query string."""
+        # the user registered right before the oldest scrobble
+        if query.get('method') == 'user.getinfo':
+            if isinstance(self.__scrobbles, ZipfHistory):
+                registered = int(self.__scrobbles.uts[-1]) if len(self.__scrobbles) > 0 else 0
+            else:
+                registered = min( (int(scrobble['date']['uts']) for scrobble in self.__scrobbles), default=0 )
+            self.requests_served += 1
+            return json.dumps({'user': {'name': query.get('user', ''), 'registered': {'unixtime': str(registered), '#text': registered}}}).encode(), 200
+
+        if query.get('method') != 'user.getrecenttracks':
+            return json.dumps({'error': 3, 'message': 'Invalid Method'}).encode(), 400
+
+        from_uts, to_uts = int(query.get('from', 0)), int(query.get('to', 2**62))
+        limit, page = int(query.get('limit', 50)), int(query.get('page', 1))
+
+        # a columnar history finds the window with a binary search and only builds the json of the requested page
+        if isinstance(self.__scrobbles, ZipfHistory):
+            first, last = self.__scrobbles.window(from_uts, to_uts)
+            total = last - first
+            tracks = self.__scrobbles.scrobbles(min(last, first + (page - 1) * limit), min(last, first + page * limit))
+        else:
+            window = [scrobble for scrobble in self.__scrobbles if from_uts <= int(scrobble['date']['uts']) <= to_uts]
+            total = len(window)
+            tracks = window[(page - 1) * limit : page * limit]
+
+        self.requests_served += 1
+        return json.dumps({'recenttracks': {
+            'track': tracks,
+            '@attr': {'user': query.get('user', ''), 'page': str(page), 'perPage': str(limit), 'totalPages': str(-(-total // limit)), 'total': str(total)}
+        }}).encode(), 200
+
+
+    def replace(self, scrobbles: Union[List[Dict[str, Any]], ZipfHistory]) -> None:
+        """Serves another list of scrobbles from the next request on (e.g. the same history with new scrobbles, to check a refresh)."""
+        self.__scrobbles = scrobbles
+
+
+    def start(self) -> None:
+        """Starts serving in a background (daemon) thread."""
+        Thread(target=self.__server.serve_forever, daemon=True).start()
+
+
+    def stop(self) -> None:
+        """Shuts the server down and releases its socket."""
+        self.__server.shutdown()
+        self.__server.server_close()